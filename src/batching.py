@@ -0,0 +1,228 @@
+""" batches of padded sents for the rnns and the reporting of their predictions, no theano needed """
+import sys, copy
+import logging
+import time
+import threading, Queue
+from collections import OrderedDict
+import random, numpy as np
+
+import rep
+import prof
+from score import conlleval_flat
+
+class Batcher(object):
+
+    def __init__(self, batch_size, feat, ids=False, batching='fixed', max_chars=4096, bucket_width=16, floatX='float32'):
+        self.batch_size = batch_size
+        self.feat = feat
+        self.ids = ids
+        self.batching = batching
+        self.max_chars = max_chars
+        self.bucket_width = bucket_width
+        self.floatX = floatX
+
+    def plan(self, dset, shuf=False):
+        """ returns a list of sentence index lists, one per batch """
+        if self.batching == 'bucket':
+            return self.bucket_plan(dset, shuf)
+        plan = [range(i, min(i+self.batch_size, len(dset))) for i in range(0, len(dset), self.batch_size)]
+        if shuf:
+            random.shuffle(plan)
+        return plan
+
+    def bucket_plan(self, dset, shuf=False):
+        lens = dset.lens.tolist()
+        buckets = {}
+        for i in np.argsort(lens, kind='mergesort'):
+            buckets.setdefault(lens[i] // self.bucket_width, []).append(i)
+        bkeys = sorted(buckets)
+        if shuf:
+            random.shuffle(bkeys)
+
+        plan = []
+        for k in bkeys:
+            bucket = buckets[k]
+            if shuf:
+                random.shuffle(bucket)
+            batch, mlen = [], 0
+            for i in bucket:
+                if len(batch) and (len(batch)+1) * max(mlen, lens[i]) > self.max_chars:
+                    plan.append(batch)
+                    batch, mlen = [], 0
+                batch.append(i)
+                mlen = max(mlen, lens[i])
+            plan.append(batch)
+        return plan
+
+    def padding_waste(self, dset, plan):
+        lens = dset.lens
+        nchar, npadded = sum(lens[idxs].sum() for idxs in plan), sum(len(idxs)*lens[idxs].max() for idxs in plan)
+        return 1 - nchar / float(npadded)
+
+    def get_batches(self, dset, plan=None):
+        plan = self.plan(dset) if plan is None else plan
+        return [self.get_batch(dset, idxs) for idxs in plan]
+
+    def get_batch(self, dset, idxs):
+        with prof.timer('batch', dset.lens[idxs].sum(), len(idxs)):
+            Xmsk_batch = dset.mask(idxs)
+            y_batch = dset.pad(self.feat.corpus_yids(dset), idxs)
+            if self.feat.compiled:
+                X_batch = dset.pad(self.feat.corpus_ids(dset), idxs) # row 0 of ftable is all-zero
+                if not self.ids:
+                    X_batch = self.feat.ftable[X_batch].astype(self.floatX)
+            else:
+                X_batch = np.zeros(Xmsk_batch.shape + (self.feat.NF,), dtype=self.floatX)
+                for si, i in enumerate(idxs):
+                    Xsent = self.feat.transform_x({'x': dset.get(i, 'x')})
+                    X_batch[si,:Xsent.shape[0]] = Xsent
+        return X_batch, Xmsk_batch, y_batch
+
+class BatchStream(object):
+    """ iterable over the batches of a dset, batches are built on demand and kept in an LRU cache """
+
+    def __init__(self, batcher, dset, ncache=-1):
+        self.batcher = batcher
+        self.dset = dset
+        self.ncache = ncache
+        self.plan = batcher.plan(dset)
+        self.plankeys = set(tuple(idxs) for idxs in self.plan)
+        self.cache = OrderedDict()
+        self.lock = threading.Lock() # a prefetching training pass may still run while the same stream is evaluated
+        self.sents = dset.take(np.concatenate(self.plan)) # sents in batch order
+
+    def __len__(self):
+        return len(self.plan)
+
+    def __iter__(self):
+        return self.iter_plan(self.plan)
+
+    def iter_plan(self, plan):
+        for idxs in plan:
+            yield self.get_batch(idxs)
+
+    def shuffled_plan(self):
+        if self.batcher.batching == 'bucket': # batch contents change
+            return self.batcher.plan(self.dset, shuf=True)
+        plan = copy.copy(self.plan)
+        random.shuffle(plan)
+        return plan
+
+    def get_batch(self, idxs):
+        key = tuple(idxs)
+        with self.lock:
+            batch = self.cache.pop(key, None)
+        if batch is None:
+            batch = self.batcher.get_batch(self.dset, idxs)
+        if self.ncache and key in self.plankeys: # only batches of the fixed plan are reused
+            with self.lock:
+                self.cache[key] = batch
+                if self.ncache > 0 and len(self.cache) > self.ncache:
+                    self.cache.popitem(last=False)
+        return batch
+
+class Prefetcher(object):
+    """ prepares the next depth batches of an iterable in a background thread while the current one is computed """
+
+    def __init__(self, depth):
+        self.depth = depth
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.nbatch, self.qdepth, self.stall = 0, 0, 0.
+
+    def __call__(self, batches):
+        q, stop, ended, end = Queue.Queue(self.depth), threading.Event(), threading.Event(), object()
+
+        def put(item): # gives up once the consumer has stopped
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for batch in batches:
+                    if not put((batch, None)):
+                        return
+                if put((end, None)):
+                    ended.set()
+            except Exception:
+                put((end, sys.exc_info())) # the traceback of the producer is kept for the consumer
+
+        producer = threading.Thread(target=produce)
+        producer.daemon = True
+        producer.start()
+        try:
+            while True:
+                self.qdepth += max(q.qsize() - ended.is_set(), 0) # the end sentinel is not a batch
+                start_time = time.time()
+                batch, err = q.get()
+                self.stall += time.time() - start_time
+                if err is not None:
+                    raise err[0], err[1], err[2]
+                if batch is end:
+                    break
+                self.nbatch += 1
+                yield batch
+        finally:
+            stop.set()
+            producer.join()
+
+class Reporter(object):
+
+    def __init__(self, level, feat, tdecoder):
+        self.feat = feat
+        self.tfunc = (lambda d, tseq: rep.get_ts_bio(d.col('wiseq'), tseq, d.coffs)) if level == 'char' else lambda d, ts: ts
+        self.tdecoder = tdecoder
+
+    def report_yerr(self, dset, pred):
+        y_true = np.concatenate([y[mask] for logprobs, mask, y in pred])
+        y_pred = np.concatenate([np.argmax(logprobs, axis=-1)[mask] for logprobs, mask, y in pred])
+        yerr = np.sum(y_true!=y_pred)/float(len(y_true))
+
+        return yerr, 0, 0, 0
+
+    def decode(self, dset, pred):
+        tpred, start = [], 0
+        for logprobs, mask, y in pred: # padded batches, in the same order as dset
+            with prof.timer('decode', mask.sum(), len(mask)):
+                tpred.extend(self.tdecoder.decode_batch(dset, np.arange(start, start+len(logprobs)), logprobs, mask))
+            start += len(logprobs)
+        return tpred
+
+    def report(self, dset, pred):
+        y_true = np.concatenate([y[mask] for logprobs, mask, y in pred])
+        pred = self.decode(dset, pred)
+        y_pred = np.concatenate(pred)
+        yerr = np.sum(y_true!=y_pred)/float(len(y_true))
+
+        # char_conmat_str = self.get_conmat_str(y_true, y_pred, self.feat.tseqenc)
+
+        ts_gold = dset.decoded('ts')
+        with prof.timer('classes', len(y_pred), len(dset)):
+            tseq_pred = self.feat.yenc.classes_[y_pred]
+        with prof.timer('ts_bio', len(y_pred), len(dset)):
+            ts_pred = self.tfunc(dset, tseq_pred)
+
+        # wacc, pre, recall, f1 = bilouEval2(lts, lts_pred)
+        with prof.timer('conlleval', len(y_pred), len(dset)):
+            (wacc, pre, recall, f1), conll_print = conlleval_flat(ts_gold, ts_pred, dset.woffs)
+        logging.debug('')
+        logging.debug(conll_print)
+        # logging.debug(char_conmat_str)
+        # logging.debug(word_conmat_str)
+        logging.debug('')
+        return yerr, pre, recall, f1
+
+    def get_conmat_str(self, y_true, y_pred, lblenc):
+        str_list = []
+        str_list.append('\t'.join(['bos'] + list(lblenc.classes_)))
+        from sklearn.metrics import confusion_matrix
+        conmat = confusion_matrix(y_true,y_pred, labels=lblenc.transform(lblenc.classes_))
+        for r,clss in zip(conmat,lblenc.classes_):
+            str_list.append('\t'.join([clss] + list(map(str,r))))
+        return '\n'.join(str_list) + '\n'
@@ -0,0 +1,274 @@
+""" micro benchmarks of the data, model and decoding hot paths, written as json to compare versions """
+import os, json, time, socket, subprocess
+import logging
+import argparse
+import multiprocessing
+import random, numpy as np
+
+from dataset import Dset, build_corpora, add_reps
+import featchar, decoder, rep
+from batching import Batcher
+from score import conlleval, perturb
+from viterbi import viterbi_log_multi
+from syngen import gen_sents
+from utils import LOG_DIR, SRC_DIR, logger
+
+BENCH_VERSION = 2
+BENCHES = ['feat_fit', 'feat_transform', 'feat_corpus_ids', 'get_batch', 'rnn_predict', 'rnn_train',
+    'viterbi_log_multi', 'decode', 'decode_batch', 'get_ts_bio', 'conlleval']
+
+def get_args():
+    parser = argparse.ArgumentParser(prog="bench")
+
+    parser.add_argument("--data", default='synth', help="synth or a lang in the data dir, e.g. cze, ned")
+    parser.add_argument("--fenc", default='utf-8', help="encoding of the data files, e.g. latin1 for ned")
+    parser.add_argument("--tokens", default=24000, type=int, help="num of synth trn words, dev and tst get a quarter of it each")
+    parser.add_argument("--mean_words", default=12, type=int, help="mean num of words of a synth sent")
+    parser.add_argument("--feat", default='basic', help="feat string, as in exper")
+    parser.add_argument("--ids", default=1, type=int, help="feed int32 row ids of the feature table instead of dense rows")
+    parser.add_argument("--batch_sizes", default=[8, 32, 128], type=int, nargs='+', help="batch sizes of the batching and rnn benches")
+    parser.add_argument("--lens", default=[32, 128, 512], type=int, nargs='+', help="sent lengths of the rnn benches")
+    parser.add_argument("--nbatch", default=4, type=int, help="num of batches of each size and length for the rnn benches")
+    parser.add_argument("--nsample", default=200, type=int, help="num of dev sents for the per sent benches")
+    parser.add_argument("--repeat", default=3, type=int, help="num of times each bench runs over its items")
+    parser.add_argument("--rnn", default='dummy', choices=['dummy','lazrnn'], help="dummy: RDNN_Dummy stands in, its train is a sleep and is not benched")
+    parser.add_argument("--rnn_args", default='', help="exper args of the lazrnn net, e.g. '--activation bi-lstm --n_hidden 128'")
+    parser.add_argument("--only", default=BENCHES, nargs='+', choices=BENCHES, help="benches to run")
+    parser.add_argument("--fork", default=1, type=int, help="run each bench in a forked process, so it starts with the same heap")
+    parser.add_argument("--out", default='', help="json file to write, default: bench-<data>-<time>.json in the logs dir")
+    parser.add_argument("--compare", default='', help="json file of an earlier run to print the speedups against")
+
+    return vars(parser.parse_args())
+
+class MemDset(object):
+    """ Dset of in-memory trn, dev and tst sent lists """
+
+    def __init__(self, splits, level='char', charrep='std'):
+        self.level = level
+        self.charrep = charrep
+        repobj = getattr(rep, 'Rep'+charrep)()
+        for d in splits:
+            add_reps(d, repobj)
+        self.trn, self.dev, self.tst = build_corpora(splits, level)
+
+def mem_kb(field):
+    """ VmRSS or VmHWM of this process in kB, 0 where /proc is missing """
+    try:
+        with open('/proc/self/status') as f:
+            for l in f:
+                if l.startswith(field+':'):
+                    return int(l.split()[1])
+    except IOError:
+        pass
+    return 0
+
+def reset_peak():
+    """ restarts the VmHWM high water mark at the current rss, linux 4.0+ """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        pass
+
+def timed(func, items, repeat):
+    """ latencies of the calls and the peak rss growth in kB """
+    reset_peak()
+    rss = mem_kb('VmRSS')
+    lats = []
+    for r in range(repeat):
+        for item in items:
+            start_time = time.time()
+            func(item)
+            lats.append(time.time() - start_time)
+    return lats, max(mem_kb('VmHWM') - rss, 0)
+
+def forked(func, *args):
+    """ func(*args) in a forked process, an exception in the child is raised again in the parent """
+    conn, child_conn = multiprocessing.Pipe()
+    def run():
+        try:
+            child_conn.send((func(*args), None))
+        except Exception as e:
+            logging.exception('bench process failed')
+            child_conn.send((None, (type(e), str(e))))
+    proc = multiprocessing.Process(target=run)
+    proc.start()
+    child_conn.close() # recv gets EOFError instead of blocking if the child dies without sending
+    try:
+        result, err = conn.recv()
+    except EOFError: # e.g. killed
+        proc.join()
+        raise RuntimeError('bench process exited with code {} without a result'.format(proc.exitcode))
+    proc.join()
+    if err is not None:
+        exc_type, msg = err
+        try:
+            exc = exc_type(msg)
+        except TypeError: # exceptions whose constructor takes other args
+            exc = RuntimeError('{}: {}'.format(exc_type.__name__, msg))
+        raise exc
+    return result
+
+def bench(name, func, items, nchars, nsents, repeat=1, fork=True, **params):
+    """
+    calls func on each item repeat times, nchars and nsents are what each item covers,
+    returns the chars and sents per sec, latency percentiles in msec and the peak rss growth in MB
+    """
+    if fork: # memory freed by an earlier bench is not reused by this one
+        lats, peak = forked(timed, func, items, repeat)
+    else:
+        lats, peak = timed(func, items, repeat)
+    lats = np.array(lats)
+    secs = lats.sum()
+    row = {'name': name, 'params': params, 'calls': len(lats), 'secs': secs,
+        'chars_sec': sum(nchars) * repeat / max(secs, 1e-9), 'sents_sec': sum(nsents) * repeat / max(secs, 1e-9),
+        'peak_mb': peak / 1024.}
+    for p in (50, 90, 99):
+        row['p{}_ms'.format(p)] = np.percentile(lats, p) * 1000
+    logging.info('{:<18} {:<28} calls: {:>5d} chars/sec: {:>12.1f} p50: {:>9.3f} p90: {:>9.3f} p99: {:>9.3f} ms peak: {:>7.1f} MB'.format(
+        name, ' '.join('{}={}'.format(k, v) for k, v in sorted(params.items())), row['calls'], row['chars_sec'],
+        row['p50_ms'], row['p90_ms'], row['p99_ms'], row['peak_mb']))
+    return row
+
+def gold_logprobs(nc, y, rng):
+    """ noisy log probs that peak at the gold labels, so the decoders see realistic sequences """
+    scores = rng.randn(len(y), nc) + 3 * np.eye(nc)[y]
+    scores -= scores.max(axis=-1, keepdims=True)
+    return scores - np.log(np.exp(scores).sum(axis=-1, keepdims=True))
+
+def run_benches(args, dset):
+    rng = np.random.RandomState(7)
+    run = lambda name, func, items, nchars, nsents, **params: bench(name, func, items, nchars, nsents, args['repeat'], args['fork'], **params)
+    only = set(args['only'])
+    trn, dev = dset.trn, dset.dev
+    rows = []
+
+    if 'feat_fit' in only:
+        rows.append(run('feat_fit', lambda d: featchar.Feat(args['feat']).fit(d), [dset], [trn.lens.sum()], [len(trn)], feat=args['feat']))
+    feat = featchar.Feat(args['feat'])
+    feat.fit(dset)
+    ids = args['ids'] and feat.compiled
+
+    sample = dev.take(sorted(rng.choice(len(dev), min(args['nsample'], len(dev)), replace=False)))
+    sents = list(sample)
+    slens, sones = sample.lens.tolist(), [1] * len(sample)
+    if 'feat_transform' in only:
+        rows.append(run('feat_transform', feat.transform_x, sents, slens, sones, feat=args['feat']))
+    if 'feat_corpus_ids' in only and feat.compiled:
+        rows.append(run('feat_corpus_ids', lambda d: (feat.corpus_cache.clear(), feat.corpus_ids(d)), [trn], [trn.lens.sum()], [len(trn)]))
+
+    if 'get_batch' in only:
+        for n_batch in args['batch_sizes']:
+            batcher = Batcher(n_batch, feat, ids)
+            plan = batcher.plan(trn)
+            rows.append(run('get_batch', lambda idxs: batcher.get_batch(trn, idxs), plan, [trn.lens[idxs].sum() for idxs in plan],
+                map(len, plan), n_batch=n_batch, ids=int(bool(ids))))
+
+    if only & set(['rnn_predict', 'rnn_train']):
+        if args['rnn'] == 'lazrnn':
+            import exper
+            from lazrnn import RDNN
+            argsd = vars(exper.get_arg_parser().parse_args(args['rnn_args'].split()))
+            argsd['drates'] = argsd['drates'] if any(argsd['drates']) else [0]*(len(argsd['n_hidden'])+1)
+            rdnn = RDNN(feat.NC, feat.NF, argsd, ftable=feat.ftable if ids else None)
+        else:
+            from lazrnn import RDNN_Dummy
+            rdnn = RDNN_Dummy(feat.NC, feat.NF, {})
+        floatX = 'float32'
+        for n_batch in args['batch_sizes']:
+            for slen in args['lens']:
+                mask = np.ones((n_batch, slen), dtype=bool)
+                batches = [(rng.randint(1, len(feat.ftable), size=mask.shape).astype(np.int32) if ids else rng.rand(n_batch, slen, feat.NF).astype(floatX),
+                    mask, rng.randint(feat.NC, size=mask.shape).astype(np.int32)) for i in range(args['nbatch'])]
+                nchars, nsents = [mask.size] * len(batches), [n_batch] * len(batches)
+                if 'rnn_predict' in only:
+                    rows.append(run('rnn_predict', lambda b: rdnn.predict([b]), batches, nchars, nsents, rnn=args['rnn'], n_batch=n_batch, slen=slen))
+                if 'rnn_train' in only and args['rnn'] != 'dummy':
+                    rows.append(run('rnn_train', lambda b: rdnn.train([b]), batches, nchars, nsents, rnn=args['rnn'], n_batch=n_batch, slen=slen))
+
+    tdecoder = decoder.ViterbiDecoder(trn, feat)
+    yids = feat.corpus_yids(sample)
+    logprobs = [gold_logprobs(feat.NC, yids[sample.coffs[i]:sample.coffs[i+1]], rng) for i in range(len(sample))]
+    if 'viterbi_log_multi' in only:
+        def vinputs(sent, lp):
+            wistates = [int(wi < 0) for wi in sent['wiseq']]
+            return lp.T, range(len(wistates)), [2 * p + w for p, w in zip([0] + wistates, wistates)]
+        items = [vinputs(sent, lp) for sent, lp in zip(sents, logprobs)]
+        rows.append(run('viterbi_log_multi', lambda (em, emissions, wmat): viterbi_log_multi(em, tdecoder.transition_tensor, emissions, wmat),
+            items, slens, sones))
+    if 'decode' in only:
+        rows.append(run('decode', lambda (sent, lp): tdecoder.decode(sent, lp), zip(sents, logprobs), slens, sones))
+    if 'decode_batch' in only:
+        for n_batch in args['batch_sizes']:
+            plan = Batcher(n_batch, feat).plan(sample)
+            items = []
+            for idxs in plan:
+                mask = sample.mask(idxs)
+                lp = np.zeros(mask.shape + (feat.NC,))
+                for si, i in enumerate(idxs):
+                    lp[si, :sample.lens[i]] = logprobs[i]
+                items.append((np.array(idxs), lp, mask))
+            rows.append(run('decode_batch', lambda (idxs, lp, mask): tdecoder.decode_batch(sample, idxs, lp, mask), items,
+                [sample.lens[idxs].sum() for idxs in plan], map(len, plan), n_batch=n_batch))
+
+    tseq = feat.yenc.classes_[feat.corpus_yids(dev)]
+    if 'get_ts_bio' in only:
+        rows.append(run('get_ts_bio', lambda d: rep.get_ts_bio(d.col('wiseq'), tseq, d.coffs), [dev], [dev.lens.sum()], [len(dev)]))
+    if 'conlleval' in only:
+        ts_gold = [dev.get(i, 'ts') for i in range(len(dev))]
+        tags = sorted(set(t for ts in ts_gold for t in ts))
+        prng = np.random.RandomState(7)
+        ts_pred = [perturb(ts, tags, prng) for ts in ts_gold]
+        rows.append(run('conlleval', lambda (g, p): conlleval(g, p), [(ts_gold, ts_pred)], [dev.lens.sum()], [len(dev)]))
+    return rows
+
+def compare(result, fname):
+    """ logs the chars/sec and p50 ratios against the same benches of an earlier run of the same version on the same data """
+    with open(fname) as f:
+        earlier = json.load(f)
+    if earlier.get('version') != result['version']:
+        logging.error('{} is of bench version {}, this is {}, not compared'.format(fname, earlier.get('version'), result['version']))
+        return
+    data = lambda r: (r['args']['data'], r['data'])
+    if data(earlier) != data(result):
+        logging.error('{} ran on {} {}, this on {} {}, not compared'.format(fname, *(data(earlier) + data(result))))
+        return
+    old = dict((json.dumps([r['name'], r['params']], sort_keys=True), r) for r in earlier['results'])
+    for r in result['results']:
+        o = old.get(json.dumps([r['name'], r['params']], sort_keys=True))
+        if o is not None:
+            logging.info('{:<18} {:<28} chars/sec x{:>7.3f} p50 x{:>7.3f}'.format(r['name'],
+                ' '.join('{}={}'.format(k, v) for k, v in sorted(r['params'].items())),
+                r['chars_sec'] / max(o['chars_sec'], 1e-9), r['p50_ms'] / max(o['p50_ms'], 1e-9)))
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=SRC_DIR, stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    args = get_args()
+    logger()
+    random.seed(7)
+    if args['data'] == 'synth':
+        rng = np.random.RandomState(7)
+        ntokens = (args['tokens'], args['tokens'] // 4, args['tokens'] // 4)
+        dset = MemDset([gen_sents(n, rng, mean_words=args['mean_words']) for n in ntokens])
+    else:
+        dset = Dset(lang=args['data'], fenc=args['fenc'])
+
+    start_time = time.time()
+    rows = run_benches(args, dset)
+    result = {'version': BENCH_VERSION, 'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'host': socket.gethostname(),
+        'commit': git_commit(), 'numpy': np.__version__, 'args': args,
+        'data': {'trn': len(dset.trn), 'dev': len(dset.dev), 'chars': int(dset.trn.lens.sum())}, 'results': rows}
+    fname = args['out'] or '{}/bench-{}-{}.json'.format(LOG_DIR, args['data'], time.strftime('%Y%m%d-%H%M%S'))
+    with open(fname, 'w') as f:
+        json.dump(result, f, indent=1, sort_keys=True)
+    logging.info('{} benches in {:.1f} sec written to {}'.format(len(rows), time.time() - start_time, fname))
+    if args['compare']:
+        compare(result, args['compare'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+import numpy as np
+
+import featchar
+
+BUNDLE_VERSION = 1
+
+def save_bundle(fname, argsd, rnn_param_values, feat, tdecoder, charrep='std'):
+    """ param values with the fitted feat, the decoder transitions and the char representation """
+    arrays = dict(('feat_'+k, v) for k, v in feat.get_state().iteritems())
+    np.savez(fname, argsd=argsd, rnn_param_values=rnn_param_values, transition_tensor=tdecoder.transition_tensor,
+            charrep=charrep, bundle_version=BUNDLE_VERSION, **arrays)
+
+def load_bundle(fname):
+    """
+    dict of argsd, rnn_param_values, feat, transition_tensor and charrep,
+    feat and transition_tensor are None for models saved with only argsd and rnn_param_values
+    """
+    dat = np.load(fname, allow_pickle=True) # argsd and rnn_param_values are pickled
+    argsd = dat['argsd'].tolist()
+    bundle = {'argsd': argsd, 'rnn_param_values': dat['rnn_param_values'], 'feat': None, 'transition_tensor': None, 'charrep': 'std'}
+    if 'bundle_version' in dat:
+        feat = featchar.Feat(argsd['feat'])
+        feat.set_state(dict((k[len('feat_'):], dat[k]) for k in dat.files if k.startswith('feat_')))
+        bundle.update({'feat': feat, 'transition_tensor': dat['transition_tensor'], 'charrep': str(dat['charrep'])})
+    return bundle
@@ -1,49 +1,223 @@
-import logging
+import logging, os, hashlib, random
 import numpy as np
 
 import rep
 import utils
 
+CACHE_VERSION = 2
+SPLITS = ('trn', 'dev', 'tst')
+WCOLS = ('ws', 'ts') # one entry per word
+CCOLS = ('cseq', 'wiseq', 'tseq') # one entry per char
+VCOLS = ('ws', 'ts', 'cseq', 'tseq') # int ids into a vocab
+
 class Dset(object):
 
-    def __init__(self, lang='eng', level='char', fenc='utf-8', tagging='bio', captrn=500, sample=0, charrep='std', sort=True, **kwargs):
+    def __init__(self, lang='eng', level='char', fenc='utf-8', tagging='bio', captrn=500, sample=0, charrep='std', sort=True, dcache=True, **kwargs):
         self.level = level
-        trn, dev, tst = utils.get_sents(lang, fenc)
-
-        repclass = getattr(rep, 'Rep'+charrep)
-        repobj = repclass()
-
-        for d in (trn,dev,tst):
-            for sent in d:
-                sent.update({
-                    'cseq': repobj.get_cseq(sent), 
-                    'wiseq': repobj.get_wiseq(sent), 
-                    'tseq': repobj.get_tseq(sent)})
-                sent['x'] = sent['cseq'] if level == 'char' else sent['ws']
-                sent['y'] = sent['tseq'] if level == 'char' else sent['ts']
-
-
-        if captrn:
-            trn = filter(lambda sent: len(' '.join(sent['ws']))<captrn, trn)
+        self.charrep = charrep
+        fname = cache_name(lang, fenc, charrep, captrn)
+        if dcache and os.path.exists(fname):
+            trn, dev, tst = load_corpora(fname, level)
+            logging.info('dset loaded from {}'.format(fname))
+        else:
+            trn, dev, tst = build_corpora(read_sents(lang, fenc, charrep, captrn), level)
+            if dcache:
+                save_corpora(fname, (trn, dev, tst))
 
         if sample>0:
             trn_size = sample*1000
-            trn = utils.sample_sents(trn,trn_size)
+            trn = trn.take(random.sample(xrange(len(trn)), trn_size))
 
         if sort:
-            trn = sorted(trn, key=lambda sent: len(sent['x']))
-            dev = sorted(dev, key=lambda sent: len(sent['x']))
-            tst = sorted(tst, key=lambda sent: len(sent['x']))
+            trn = trn.take(np.argsort(trn.lens, kind='mergesort'))
+            dev = dev.take(np.argsort(dev.lens, kind='mergesort'))
+            tst = tst.take(np.argsort(tst.lens, kind='mergesort'))
 
         ntrnsent, ndevsent, ntstsent = list(map(len, (trn,dev,tst)))
         logging.info('# of sents trn, dev, tst: {} {} {}'.format(ntrnsent, ndevsent, ntstsent))
 
         for dset, dname in zip((trn,dev,tst),('trn','dev','tst')):
-            slens = [len(sent['x']) for sent in dset]
+            slens = dset.lens
             MAX_LENGTH, MIN_LENGTH, AVG_LENGTH, STD_LENGTH = max(slens), min(slens), np.mean(slens), np.std(slens)
             logging.info('input: {}\tmaxlen: {} minlen: {} avglen: {:.2f} stdlen: {:.2f}'.format(dname,MAX_LENGTH, MIN_LENGTH, AVG_LENGTH, STD_LENGTH))
         self.trn, self.dev, self.tst = trn, dev, tst
 
+class Corpus(object):
+    """
+    sentences of a split stored column-wise: ws, ts, cseq and tseq are flat ids into shared vocabs,
+    wiseq is a flat int array, sentence i spans woffs[i]:woffs[i+1] of the word columns and coffs[i]:coffs[i+1] of the char columns
+    """
+    __slots__ = ('level', 'vocabs', 'cols', 'woffs', 'coffs', 'lens', '__weakref__')
+
+    def __init__(self, vocabs, cols, woffs, coffs, level='char'):
+        self.vocabs = vocabs
+        self.cols = cols
+        self.woffs = woffs
+        self.coffs = coffs
+        self.level = level
+        self.lens = np.diff(self.offsets('x')) # x length of each sent
+
+    def __len__(self):
+        return len(self.coffs) - 1
+
+    def __getitem__(self, i):
+        return Sent(self, i)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield Sent(self, i)
+
+    def colname(self, k):
+        if k == 'x':
+            return 'cseq' if self.level == 'char' else 'ws'
+        elif k == 'y':
+            return 'tseq' if self.level == 'char' else 'ts'
+        return k
+
+    def col(self, k):
+        return self.cols[self.colname(k)]
+
+    def vocab(self, k):
+        return self.vocabs[self.colname(k)]
+
+    def offsets(self, k):
+        return self.coffs if self.colname(k) in CCOLS else self.woffs
+
+    def get(self, i, k):
+        """ column k of sentence i as a list, vocab columns are decoded into strings """
+        k = self.colname(k)
+        offsets = self.offsets(k)
+        ids = self.cols[k][offsets[i]:offsets[i+1]]
+        return (self.vocabs[k][ids] if k in VCOLS else ids).tolist()
+
+    def decoded(self, k):
+        """ column k of all sents as an array of strings """
+        return self.vocab(k)[self.col(k)]
+
+    def take(self, idxs):
+        """ new corpus with the sents idxs in the given order """
+        idxs = np.asarray(idxs, dtype=np.int64)
+        cols = {}
+        woffs, wpos = gather(self.woffs, idxs)
+        coffs, cpos = gather(self.coffs, idxs)
+        for k in WCOLS: cols[k] = self.cols[k][wpos]
+        for k in CCOLS: cols[k] = self.cols[k][cpos]
+        return Corpus(self.vocabs, cols, woffs, coffs, self.level)
+
+    def mask(self, idxs):
+        """ nsent x maxlen bool mask of the sents idxs """
+        lens = self.lens[idxs]
+        return np.arange(lens.max()) < lens[:,np.newaxis]
+
+    def pad(self, flat, idxs, fill=0):
+        """ flat is aligned with the x column, returns the padded nsent x maxlen array of the sents idxs """
+        mask = self.mask(idxs)
+        padded = np.empty(mask.shape, dtype=flat.dtype)
+        padded.fill(fill)
+        starts = self.offsets('x')[np.asarray(idxs)]
+        padded[mask] = flat[(starts[:,np.newaxis] + np.arange(mask.shape[1]))[mask]]
+        return padded
+
+class Sent(object):
+    """ view of a sentence of a Corpus, indexed with the keys of the former sentence dicts """
+    __slots__ = ('corpus', 'i')
+
+    def __init__(self, corpus, i):
+        self.corpus = corpus
+        self.i = i
+
+    def __getitem__(self, k):
+        return self.corpus.get(self.i, k)
+
+def gather(offsets, idxs):
+    """ offsets of the sents idxs placed one after another and the positions of their elements in the flat column """
+    lens = offsets[idxs+1] - offsets[idxs]
+    new_offsets = np.concatenate(([0], np.cumsum(lens)))
+    pos = np.arange(new_offsets[-1]) - np.repeat(new_offsets[:-1] - offsets[idxs], lens)
+    return new_offsets, pos
+
+def read_sents(lang, fenc, charrep, captrn):
+    trn, dev, tst = utils.get_sents(lang, fenc)
+
+    repclass = getattr(rep, 'Rep'+charrep)
+    repobj = repclass()
+
+    for d in (trn,dev,tst):
+        add_reps(d, repobj)
+
+    if captrn:
+        trn = filter(lambda sent: len(' '.join(sent['ws']))<captrn, trn)
+    return trn, dev, tst
+
+def add_reps(sents, repobj):
+    for sent in sents:
+        sent.update({
+            'cseq': repobj.get_cseq(sent),
+            'wiseq': repobj.get_wiseq(sent),
+            'tseq': repobj.get_tseq(sent)})
+
+def from_words(wss, level='char', charrep='std', tss=None):
+    """ corpus of tokenized sents that are not part of a dataset, tags default to O """
+    tss = tss if tss is not None else [['O']*len(ws) for ws in wss]
+    sents = [{'ws':ws, 'ts':ts} for ws, ts in zip(wss, tss)]
+    add_reps(sents, getattr(rep, 'Rep'+charrep)())
+    return build_corpora([sents], level)[0]
+
+def build_corpora(dsets, level='char'):
+    """ converts lists of sentence dicts with ws, ts, cseq, wiseq, tseq into corpora with shared vocabs """
+    vindx = dict((k, {}) for k in VCOLS)
+    parts = []
+    for d in dsets:
+        cols = {}
+        for k in VCOLS:
+            cols[k], offsets = encode([sent[k] for sent in d], vindx[k])
+            if k == 'ws': woffs = offsets
+            if k == 'cseq': coffs = offsets
+        cols['wiseq'] = np.array([wi for sent in d for wi in sent['wiseq']], dtype=np.int32)
+        parts.append((cols, woffs, coffs))
+    vocabs = dict((k, np.array(sorted(vindx[k], key=vindx[k].get))) for k in VCOLS)
+    for cols, woffs, coffs in parts: # ids are stored in the smallest int type that holds them
+        for k in VCOLS:
+            cols[k] = cols[k].astype(np.min_scalar_type(len(vocabs[k])))
+        cols['wiseq'] = cols['wiseq'].astype(np.int16 if np.diff(woffs).max() < 2**15 else np.int32)
+    return [Corpus(vocabs, cols, woffs, coffs, level) for cols, woffs, coffs in parts]
+
+def encode(seqs, vocab):
+    """ flat int32 ids of all elements and the offsets of each seq, vocab is extended in place """
+    ids = np.array([vocab.setdefault(e, len(vocab)) for seq in seqs for e in seq], dtype=np.int32)
+    offsets = np.cumsum([0] + [len(seq) for seq in seqs])
+    return ids, offsets
+
+def cache_name(lang, fenc, charrep, captrn):
+    """ sampling and sorting are applied after loading, so the cache does not depend on them """
+    fnames = ['{}/{}/{}.bio'.format(utils.DATA_DIR, lang, d) for d in ('train','testa','testb')]
+    key = repr((CACHE_VERSION, lang, fenc, charrep, captrn, [os.path.getmtime(f) for f in fnames]))
+    return '{}/dset-{}-{}.npz'.format(utils.CACHE_DIR, lang, hashlib.md5(key).hexdigest())
+
+def save_corpora(fname, corpora):
+    arrays = {}
+    for k in VCOLS:
+        arrays['{}_vocab'.format(k)] = corpora[0].vocabs[k]
+    for dname, corpus in zip(SPLITS, corpora):
+        for k, col in corpus.cols.iteritems():
+            arrays['{}_{}'.format(dname, k)] = col
+        arrays['{}_ws_offsets'.format(dname)] = corpus.woffs
+        arrays['{}_cseq_offsets'.format(dname)] = corpus.coffs
+
+    if not os.path.exists(utils.CACHE_DIR):
+        os.makedirs(utils.CACHE_DIR)
+    tmp = '{}.{}.tmp'.format(fname, os.getpid()) # renamed when complete, concurrent runs never read a partial file
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+    os.rename(tmp, fname)
+    logging.info('dset saved to {}'.format(fname))
+
+def load_corpora(fname, level='char'):
+    arrays = np.load(fname)
+    vocabs = dict((k, arrays[k+'_vocab']) for k in VCOLS)
+    return [Corpus(vocabs, dict((k, arrays[dname+'_'+k]) for k in WCOLS+CCOLS),
+        arrays[dname+'_ws_offsets'], arrays[dname+'_cseq_offsets'], level) for dname in SPLITS]
+
 if __name__ == '__main__':
     utils.logger()
     dset = Dset(level='word')
@@ -3,16 +3,19 @@ import logging
 from itertools import imap, groupby
 from tabulate import tabulate
 
+import prof
+
 class WDecoder(object):
 
-    def __init__(self, trn, feat):
+    def __init__(self, trn, feat, transition_tensor=None):
         self.feat = feat
+        if transition_tensor is not None: # saved with the model
+            self.transition_tensor = transition_tensor
+            return
         # self.states = dd(set)
         self.transition_tensor = np.zeros((1, feat.NC, feat.NC)) + np.log(np.finfo(float).eps)
-        for sent in trn:
-            tseq = feat.yenc.transform([t for t in sent['y']])
-            for t,tprev in zip(tseq[1:],tseq):
-                self.transition_tensor[0,tprev,t] = 1
+        tseq, nexts = feat.corpus_yids(trn), inner_nexts(trn.offsets('y'))
+        self.transition_tensor[0,tseq[nexts-1],tseq[nexts]] = 1
         logging.info('transition tensor:')
         logging.info(tabulate(self.transition_tensor[0]))
 
@@ -35,26 +38,26 @@ class WDecoder(object):
 
         return tseq_ints
 
-class ViterbiDecoder(object):
+    def decode_batch(self, dset, idxs, logprobs, mask):
+        from viterbi import viterbi_log_batch
 
-    def __init__(self, trn, feat):
-        from collections import defaultdict as dd
+        wmat = np.zeros(mask.shape, dtype=np.int32)
+        tseqs = viterbi_log_batch(logprobs, self.transition_tensor, wmat, mask)
+        return [tseq[:slen] for tseq, slen in zip(tseqs, mask.sum(axis=-1))]
 
-        self.feat = feat
+class ViterbiDecoder(object):
 
-        self.states = dd(set)
-        for sent in trn:
-            wistates =  map(lambda x:int(x<0), sent['wiseq'])
-            tseq = feat.yenc.transform([t for t in sent['tseq']])
-            # for (tprev,t), (wstate_prev, wstate) in zip(zip(tseq[1:],tseq), zip(wistates[1:], wistates)):
-            for (t,tprev), (wstate, wstate_prev) in zip(zip(tseq[1:],tseq), zip(wistates[1:], wistates)):
-                indx = int(''.join(map(str,(wstate_prev,wstate))), 2)
-                # states[(wstate_prev,wstate)].add((tprev,t))
-                self.states[indx].add((tprev,t))
-        self.transition_tensor = np.zeros((len(self.states.keys()), feat.NC, feat.NC)) + np.log(np.finfo(float).eps)
-        for i, valids in self.states.iteritems():
-            for k,l in valids:
-                self.transition_tensor[i,k,l] = 1
+    def __init__(self, trn, feat, transition_tensor=None):
+        self.feat = feat
+        if transition_tensor is not None: # saved with the model
+            self.transition_tensor = transition_tensor
+            return
+
+        wistates = (trn.col('wiseq') < 0).astype(np.int32)
+        tseq, nexts = feat.corpus_yids(trn), inner_nexts(trn.coffs)
+        indxs = 2 * wistates[nexts-1] + wistates[nexts] # (wstate_prev,wstate) as a binary number
+        self.transition_tensor = np.zeros((indxs.max()+1, feat.NC, feat.NC)) + np.log(np.finfo(float).eps)
+        self.transition_tensor[indxs,tseq[nexts-1],tseq[nexts]] = 1
         for i in range(self.transition_tensor.shape[0]):
             logging.debug(self.transition_tensor[i])
 
@@ -77,6 +80,34 @@ class ViterbiDecoder(object):
 
         return tseq_ints
 
+    def decode_batch(self, dset, idxs, logprobs, mask):
+        from viterbi import viterbi_log_batch
+
+        wiseqs = dset.pad(dset.col('wiseq'), idxs)
+        wistates = (wiseqs < 0).astype(np.int32)
+        wmat = 2 * np.concatenate((np.zeros((len(wistates),1), dtype=np.int32), wistates[:,:-1]), axis=1) + wistates
+        with prof.timer('viterbi', mask.sum(), len(mask)):
+            tseqs = viterbi_log_batch(logprobs, self.transition_tensor, wmat, mask)
+
+        for si in np.flatnonzero(~self.sanity_check_batch(wiseqs, tseqs, mask)):
+            sent, slen = dset[idxs[si]], mask[si].sum()
+            logging.critical(' '.join(sent['ws']))
+            logging.critical(' '.join(sent['ts']))
+            logging.critical('gold tseq: {}'.format(sent['tseq']))
+            logging.critical('decoded tseq: {}'.format(tseqs[si,:slen]))
+            logging.critical(logprobs[si,:slen])
+            raise Exception('decoder sanity check failed')
+
+        return [tseq[:slen] for tseq, slen in zip(tseqs, mask.sum(axis=-1))]
+
+    def sanity_check_batch(self, wiseqs, tseqs, mask):
+        """ sanity_check over padded batches, a tagged space must have the same tag as its neighbours """
+        classes = self.feat.yenc.classes_.tolist()
+        o_id = classes.index('o') if 'o' in classes else -1
+        t, tprev, tnext = tseqs[:,1:-1], tseqs[:,:-2], tseqs[:,2:]
+        bad = (wiseqs[:,1:-1] == -1) & mask[:,1:-1] & (t != o_id) & ((tprev != t) | (tnext != t))
+        return ~bad.any(axis=1)
+
     def sanity_check(self, sent, tseq_ints):
         tseq = self.feat.yenc.inverse_transform(tseq_ints)
         if any(len(set(group)) != 1 for k, group in groupby(filter(lambda x: x[0]>-1, zip(sent['wiseq'], tseq)))):
@@ -101,6 +132,18 @@ class ViterbiDecoder(object):
             print tabulate(table)
         """
 
+def get_decoder(level, feat, trn=None, transition_tensor=None):
+    """ decoder of the level, its transitions are counted on trn unless transition_tensor is given """
+    if level == 'char':
+        return ViterbiDecoder(trn, feat, transition_tensor)
+    return WDecoder(trn, feat, transition_tensor)
+
+def inner_nexts(offsets):
+    """ flat indexes that are not the first of their sent, so i-1 and i are consecutive in a sent """
+    starts = np.zeros(offsets[-1], dtype=bool)
+    starts[offsets[:-1][np.diff(offsets) > 0]] = True
+    return np.flatnonzero(~starts)
+
 def randlogprob(sent, nc):
     sent_len = len(sent['cseq'])
     randvals = np.random.rand(sent_len, nc)
@@ -109,12 +152,16 @@ def randlogprob(sent, nc):
 
 class MaxDecoder(object):
 
-    def __init__(self, trn, feat):
+    def __init__(self, trn, feat, transition_tensor=None):
         pass
 
     def decode(self, sent, logprobs, debug=False):
         return np.argmax(logprobs, axis=-1).flatten()
 
+    def decode_batch(self, dset, idxs, logprobs, mask):
+        tseqs = np.argmax(logprobs, axis=-1)
+        return [tseq[:slen] for tseq, slen in zip(tseqs, mask.sum(axis=-1))]
+
     def sanity_check(self, sent, tseq_ints):
         return True
 
@@ -142,7 +189,7 @@ def main():
     feat = featchar.Feat('basic')
     feat.fit(dset)
 
-    vdecoder = ViterbiDecoder(trn, feat)
+    vdecoder = ViterbiDecoder(dset.trn, feat)
     vdecoder.pprint()
     sent = trn[0]
     vdecoder.decode(sent, randlogprob(sent, feat.NC), debug=True)
@@ -1,28 +1,29 @@
-import copy
+import json
 import logging
 import argparse
 import time
-from itertools import chain
+import itertools
 import random, numpy as np
 
 import theano
 import lasagne
-from sklearn.metrics import confusion_matrix
 
 from dataset import Dset
 import featchar, decoder
-import rep
+import prof
 from utils import valid_file_name
 from utils import LOG_DIR, MODEL_DIR
-from score import conlleval
+from bundle import save_bundle, load_bundle
+from batching import Batcher, BatchStream, Prefetcher, Reporter
 from lazrnn import RDNN, RDNN_Dummy
+from parallel import ParallelTrainer
 
 random.seed(7)
 np.random.seed(7)
 rng = np.random.RandomState(1234567)
 lasagne.random.set_rng(rng)
 
-def get_args():
+def get_arg_parser():
     parser = argparse.ArgumentParser(prog="lazrnn")
     
     parser.add_argument("--rnn", default='lazrnn', choices=['dummy','lazrnn'], help="which rnn to use")
@@ -37,13 +38,30 @@ def get_args():
     parser.add_argument("--norm", default=1, type=float, help="Threshold for clipping norm of gradient")
     parser.add_argument("--n_batch", default=32, type=int, help="batch size")
     parser.add_argument("--fepoch", default=600, type=int, help="number of epochs")
+    parser.add_argument("--eval_every", default=1, type=int, help="evaluate every this many epochs, the last epoch is always evaluated")
+    parser.add_argument("--eval_updates", default=0, type=int, help="evaluate every this many updates instead of every --eval_every epochs, 0: off")
+    parser.add_argument("--patience", default=0, type=int, help="stop after this many evals without a better dev f1, 0: off")
+    parser.add_argument("--tst_best", default=0, type=int, help="evaluate tst only when dev f1 improves")
+    parser.add_argument("--trn_eval", default='full', choices=['full','train','sample'], help="trn error from a full prediction pass, the dropout-on training pass or a prediction pass over a fixed sample")
+    parser.add_argument("--trn_sample", default=1000, type=int, help="num of trn sents to predict with --trn_eval sample")
+    parser.add_argument("--prof", default=0, type=int, help="log the time, chars/sec and sents/sec of each stage every epoch")
+    parser.add_argument("--workers", default=0, type=int, help="num of forked training processes with averaged params, 0: train in this process")
+    parser.add_argument("--sync", default=1, type=int, help="num of batches each worker trains on between param averagings")
     parser.add_argument("--sample", default=0, type=int, help="num of sents to sample from trn in the order of K")
     parser.add_argument("--feat", default='basic', help="feat func to use")
     parser.add_argument("--emb", default=0, type=int, help="embedding layer size")
+    parser.add_argument("--ids", default=1, type=int, help="feed int32 feature ids instead of dense one-hot inputs, only for compiled feats")
     parser.add_argument("--gclip", default=0, type=float, help="clip gradient messages in recurrent layers if they are above this value")
     parser.add_argument("--truncate", default=-1, type=int, help="backward step size")
     parser.add_argument("--log", default='das_auto', help="log file name")
     parser.add_argument("--sorted", default=1, type=int, help="sort datasets before training and prediction")
+    parser.add_argument("--dcache", default=1, type=int, help="load/save preprocessed datasets from/to the cache dir")
+    parser.add_argument("--fcache", default=1, type=int, help="load/save compiled theano functions from/to the cache dir")
+    parser.add_argument("--batching", default='fixed', choices=['fixed','bucket'], help="fixed: n_batch sents per batch, bucket: length buckets filled up to max_chars")
+    parser.add_argument("--max_chars", default=4096, type=int, help="max padded chars per batch for bucket batching")
+    parser.add_argument("--bucket_width", default=16, type=int, help="length range of a bucket for bucket batching")
+    parser.add_argument("--bcache", default=-1, type=int, help="num of prepared batches to cache per dset, -1: all, 0: none")
+    parser.add_argument("--prefetch", default=0, type=int, help="num of batches to prepare ahead in a background thread, 0: off")
     parser.add_argument("--in2out", default=0, type=int, help="connect input & output")
     parser.add_argument("--lang", default='eng', help="ner lang")
     parser.add_argument("--shuf", default=1, type=int, help="shuffle the batches.")
@@ -56,140 +74,171 @@ def get_args():
 
     parser.add_argument("--save", default='', help="save param values to file")
     parser.add_argument("--load", default='', help="load param values from file")
+    parser.add_argument("--eval_only", default=0, type=int, help="only score the loaded model on dev and tst, no gradients or updates are compiled")
+    parser.add_argument("--unroll", default=0, type=int, help="with --eval_only, unroll the recurrent layers to this fixed length instead of scanning, -1: max sent length of dev and tst")
 
-    args = vars(parser.parse_args())
+    return parser
+
+def get_args(parser=None):
+    args = vars((parser or get_arg_parser()).parse_args())
     args['drates'] = args['drates'] if any(args['drates']) else [0]*(len(args['n_hidden'])+1)
 
     return args
 
-
-
-class Batcher(object):
-
-    def __init__(self, batch_size, feat):
-        self.batch_size = batch_size
-        self.feat = feat
-
-    def get_batches(self, dset):
-        nf = self.feat.NF 
-        sent_batches = [dset[i:i+self.batch_size] for i in range(0, len(dset), self.batch_size)]
-        batches = []
-        for batch in sent_batches:
-            mlen = max(len(sent['x']) for sent in batch)
-            X_batch = np.zeros((len(batch), mlen, nf),dtype=theano.config.floatX)
-            Xmsk_batch = np.zeros((len(batch), mlen),dtype=np.bool)
-            y_batch = np.zeros((len(batch), mlen, self.feat.NC),dtype=theano.config.floatX)
-            ymsk_batch = np.zeros((len(batch), mlen, self.feat.NC),dtype=np.bool)
-            for si, sent in enumerate(batch):
-                Xsent, ysent = self.feat.transform(sent)
-                nchar = Xsent.shape[0]
-                X_batch[si,:nchar,:] = Xsent
-                Xmsk_batch[si,:nchar] = True
-                y_batch[si,:nchar,:] = ysent
-                ymsk_batch[si,:nchar,:] = True
-            batches.append((X_batch, Xmsk_batch, y_batch, ymsk_batch))
-        return batches
-
-class Reporter(object):
-
-    def __init__(self, dset, feat):
-        self.feat = feat
-        self.tfunc = rep.get_ts_bio if dset.level == 'char' else lambda x,y: y
-        # self.tdecoder = decoder.ViterbiDecoder(dset.trn, feat) if dset.level == 'char' else decoder.MaxDecoder(dset.trn, feat)
-        self.tdecoder = decoder.ViterbiDecoder(dset.trn, feat) if dset.level == 'char' else decoder.WDecoder(dset.trn, feat)
-
-    def report_yerr(self, dset, pred):
-        pred = [np.argmax(p, axis=-1).flatten() for p in pred]
-        y_true = self.feat.yenc.transform([t for sent in dset for t in sent['y']])
-        y_pred = list(chain.from_iterable(pred))
-        yerr = np.sum(y_true!=y_pred)/float(len(y_true))
-
-        return yerr, 0, 0, 0
-
-    def report(self, dset, pred):
-        pred = [self.tdecoder.decode(s, p) for s, p in zip(dset, pred)]
-        y_true = self.feat.yenc.transform([t for sent in dset for t in sent['y']])
-        y_pred = list(chain.from_iterable(pred))
-        yerr = np.sum(y_true!=y_pred)/float(len(y_true))
-
-        # char_conmat_str = self.get_conmat_str(y_true, y_pred, self.feat.tseqenc)
-
-        lts = [sent['ts'] for sent in dset]
-        lts_pred = []
-        for sent, ipred in zip(dset, pred):
-            tseq_pred = self.feat.yenc.inverse_transform(ipred)
-            # tseqgrp_pred = get_tseqgrp(sent['wiseq'],tseq_pred)
-            ts_pred = self.tfunc(sent['wiseq'],tseq_pred)
-            lts_pred.append(ts_pred) # changed
-
-        # wacc, pre, recall, f1 = bilouEval2(lts, lts_pred)
-        (wacc, pre, recall, f1), conll_print = conlleval(lts, lts_pred)
-        logging.debug('')
-        logging.debug(conll_print)
-        # logging.debug(char_conmat_str)
-        # logging.debug(word_conmat_str)
-        logging.debug('')
-        return yerr, pre, recall, f1
-
-    def get_conmat_str(self, y_true, y_pred, lblenc):
-        str_list = []
-        str_list.append('\t'.join(['bos'] + list(lblenc.classes_)))
-        conmat = confusion_matrix(y_true,y_pred, labels=lblenc.transform(lblenc.classes_))
-        for r,clss in zip(conmat,lblenc.classes_):
-            str_list.append('\t'.join([clss] + list(map(str,r))))
-        return '\n'.join(str_list) + '\n'
-
 class Validator(object):
 
-    def __init__(self, dset, batcher, reporter):
+    def __init__(self, dset, batcher, reporter, ncache=-1, prefetch=0, trn_eval='full', trn_sample=1000, metrics=None):
         self.dset = dset
-        self.trndat = batcher.get_batches(dset.trn) 
-        self.devdat = batcher.get_batches(dset.dev) 
-        self.tstdat = batcher.get_batches(dset.tst) 
+        self.metrics = open(metrics, 'w') if metrics else None # json lines of the evals next to the info log
+        self.nupdate = 0
+        self.prefetcher = Prefetcher(prefetch) if prefetch else None
+        self.trndat = BatchStream(batcher, dset.trn, ncache)
+        self.trn_eval = trn_eval
+        if trn_eval == 'sample': # the same sents every epoch, in the length order of trn
+            idxs = sorted(random.Random(7).sample(xrange(len(dset.trn)), min(trn_sample, len(dset.trn))))
+            self.trnsample = BatchStream(batcher, dset.trn.take(idxs), ncache)
+        self.devdat = BatchStream(batcher, dset.dev, ncache)
+        self.tstdat = BatchStream(batcher, dset.tst, ncache)
+        for dname, ddat in zip(('trn','dev','tst'), (self.trndat, self.devdat, self.tstdat)):
+            logging.info('{:<5} {:<5} nbatch: {} padding: {:.4f}'.format('pad', dname, len(ddat), batcher.padding_waste(ddat.dset, ddat.plan)))
         self.reporter = reporter
         self.batcher = batcher
 
-    def validate(self, rdnn, argsd):
+    def feed(self, batches):
+        return self.prefetcher(batches) if self.prefetcher else batches
+
+    def log_metrics(self, **row):
+        if self.metrics:
+            self.metrics.write(json.dumps(row, sort_keys=True) + '\n')
+            self.metrics.flush()
+
+    def log_eval(self, datname, e, mcost, mtime, yerr, pre, recall, f1, best, best_epoch):
+        logging.info(('{:<5} {:<5d} {:>12.4e} ' + ('{:>10.4f} '*6)+'{:>10d}')\
+            .format(datname, e, mcost, mtime, yerr, pre, recall, f1, best, best_epoch))
+        self.log_metrics(dset=datname, epoch=e, nupdate=self.nupdate, mcost=float(mcost), mtime=mtime, yerr=float(yerr),
+                pre=float(pre), recall=float(recall), f1=float(f1), best=float(best), best_epoch=best_epoch, time=time.time())
+
+    def evaluate(self, rdnn, argsd=None):
+        """ scores a trained model on dev and tst once """
+        self.log_metrics(args=argsd)
+        logging.info(('{:<5} {:<5} {:>12} ' + ('{:>10} '*5)).format('dset','epoch','mcost', 'mtime', 'yerr', 'pre', 'recall', 'f1'))
+        for ddat, datname in zip([self.devdat, self.tstdat],['dev','tst']):
+            start_time = time.time()
+            mcost, pred = rdnn.predict(self.feed(ddat))
+            yerr, pre, recall, f1 = self.reporter.report(ddat.sents, pred)
+            mtime = time.time() - start_time
+            logging.info(('{:<5} {:<5d} {:>12.4e} ' + ('{:>10.4f} '*5)).format(datname, 0, mcost, mtime, yerr, pre, recall, f1))
+            self.log_metrics(dset=datname, epoch=0, nupdate=0, mcost=float(mcost), mtime=mtime, yerr=float(yerr),
+                    pre=float(pre), recall=float(recall), f1=float(f1), time=time.time())
+        if prof.ENABLED:
+            self.log_metrics(dset='prof', epoch=0, stages=prof.report('prof', 0))
+
+    def validate(self, rdnn, argsd, trainer=None):
         logging.info('training the model...')
+        self.log_metrics(args=argsd)
+        trainer = trainer or rdnn
         dbests = {'trn':(1,0.), 'dev':(1,0.), 'tst':(1,0.)}
+        etimes = {} # duration of the last eval pass of each dset, estimates the time saved by skipping one
+        nupdate, nstale, tsaved = 0, 0, 0.
+        trncounts, trncost = np.zeros(2, dtype=np.int64), [] # of the training passes since the last eval
+        eval_updates, patience = argsd['eval_updates'], argsd['patience']
 
         for e in range(1,argsd['fepoch']+1): # foreach epoch
             logging.info(('{:<5} {:<5} {:>12} ' + ('{:>10} '*7)).format('dset','epoch','mcost', 'mtime', 'yerr', 'pre', 'recall', 'f1', 'best', 'best'))
-            """ training """
-            trndat = copy.copy(self.trndat)
-            if argsd['shuf']:
-                random.shuffle(trndat) 
-
-            start_time = time.time()
-            mcost = rdnn.train(trndat)
-            end_time = time.time(); mtime = end_time - start_time
-            logging.info(('{:<5} {:<5d} {:>12.4e} {:>10.4f}').format('trn0',e,mcost, mtime))
-            """ end training """
-
-            """ predictions """
-            for ddat, datname, dset in zip([self.trndat,self.devdat, self.tstdat],['trn','dev','tst'], [self.dset.trn, self.dset.dev, self.dset.tst]):
-            # for ddat, datname, dset in zip([self.devdat, self.tstdat],['dev','tst'], [self.dev, self.tst]):
+            trnplan = self.trndat.shuffled_plan() if argsd['shuf'] else self.trndat.plan
+            if self.batcher.batching == 'bucket' and argsd['shuf']: # batch contents change every epoch
+                logging.info('{:<5} {:<5d} nbatch: {} padding: {:.4f}'.format('pad', e, len(trnplan), self.batcher.padding_waste(self.dset.trn, trnplan)))
+            trndat = iter(self.feed(self.trndat.iter_plan(trnplan)))
+
+            nevals, nskips, remaining = 0, 0, len(trnplan)
+            while remaining > 0: # segments of training between evaluations
+                """ training """
+                nseg = min(eval_updates - nupdate % eval_updates, remaining) if eval_updates else remaining
                 start_time = time.time()
-                mcost, pred = rdnn.predict(ddat)
-                pred = [p for b in pred for p in b]
-                end_time = time.time()
-                mtime = end_time - start_time
-                
-                if datname=='trn':
-                    yerr, pre, recall, f1 = self.reporter.report_yerr(dset, pred) 
+                mcost = trainer.train(itertools.islice(trndat, nseg))
+                end_time = time.time(); mtime = end_time - start_time
+                trncounts += trainer.train_counts; trncost.append(mcost)
+                logging.info(('{:<5} {:<5d} {:>12.4e} {:>10.4f}').format('trn0',e,mcost, mtime))
+                nupdate += nseg; remaining -= nseg
+                self.nupdate = nupdate
+                self.log_metrics(dset='trn0', epoch=e, nupdate=nupdate, mcost=float(mcost), mtime=mtime, time=time.time())
+                """ end training """
+
+                if eval_updates:
+                    due = nupdate % eval_updates == 0 or (e == argsd['fepoch'] and remaining == 0) # the last partial segment is scored too
                 else:
-                    yerr, pre, recall, f1 = self.reporter.report(dset, pred) 
-                
-                if f1 > dbests[datname][1]:
-                    dbests[datname] = (e,f1)
-                    if argsd['save'] and datname == 'dev': # save model to file
-                        rnn_param_values = rdnn.get_param_values()
-                        np.savez('{}/{}'.format(MODEL_DIR, argsd['save']), argsd=argsd, rnn_param_values=rnn_param_values)
-
-                logging.info(('{:<5} {:<5d} {:>12.4e} ' + ('{:>10.4f} '*6)+'{:>10d}')\
-                    .format(datname, e, mcost, mtime, yerr, pre, recall, f1, dbests[datname][1], dbests[datname][0]))
-            """ end predictions """
+                    due = e % argsd['eval_every'] == 0 or e == argsd['fepoch']
+                if not due:
+                    nskips += 1; tsaved += sum(etimes.get(datname, 0.) for datname in ('trn','dev','tst'))
+                    continue
+
+                """ predictions """
+                nevals += 1
+                improved = False
+                for ddat, datname in zip([self.trndat,self.devdat, self.tstdat],['trn','dev','tst']):
+                    if datname == 'tst' and argsd['tst_best'] and not improved:
+                        tsaved += etimes.get(datname, 0.)
+                        continue
+                    if datname == 'trn' and self.trn_eval == 'train':
+                        self.report_train(e, np.mean(trncost), trncounts, dbests)
+                        continue
+                    if datname == 'trn' and self.trn_eval == 'sample':
+                        ddat = self.trnsample
+                    better = self.evaluate_dset(rdnn, ddat, datname, e, dbests, etimes, argsd)
+                    improved = improved or (better and datname == 'dev')
+                """ end predictions """
+                trncounts[:], trncost = 0, []
+                nstale = 0 if improved else nstale + 1
+                if patience and nstale >= patience:
+                    break
+
+            logging.info('{:<5} {:<5d} nupdate: {} evals: {} skipped: {} saved: {:.4f}'.format('sched', e, nupdate, nevals, nskips, tsaved))
+            if trainer is not rdnn:
+                sps, wait = trainer.throughput()
+                logging.info('{:<5} {:<5d} workers: {} sents/sec: {:.2f} wait: {:.4f}'.format('par', e, trainer.nworkers, sps, wait))
+                trainer.reset_stats()
+            if prof.ENABLED:
+                self.log_metrics(dset='prof', epoch=e, stages=prof.report('prof', e))
+            if self.prefetcher:
+                pf = self.prefetcher
+                logging.info('{:<5} {:<5d} nbatch: {} qdepth: {:.2f} stall: {:.4f}'.format('pref', e, pf.nbatch, pf.qdepth / float(max(pf.nbatch, 1)), pf.stall))
+                pf.reset_stats()
             logging.info('')
+            if patience and nstale >= patience:
+                logging.info('early stopping, no dev improvement in the last {} evals, best dev f1: {:.4f} at epoch {}'.format(
+                    patience, dbests['dev'][1], dbests['dev'][0]))
+                break
+
+    def report_train(self, e, mcost, trncounts, dbests):
+        """ trn error counted in the training passes since the last eval, no extra prediction pass """
+        nerr, ntok = trncounts
+        yerr = nerr / float(max(ntok, 1))
+        self.log_eval('trn', e, mcost, 0., yerr, 0., 0., 0., dbests['trn'][1], dbests['trn'][0])
+
+    def evaluate_dset(self, rdnn, ddat, datname, e, dbests, etimes, argsd):
+        """ predicts and reports one dset, returns whether its best f1 improved, saves the model on a new best dev f1 """
+        dset = ddat.sents
+        start_time = time.time()
+        mcost, pred = rdnn.predict(self.feed(ddat))
+        end_time = time.time()
+        mtime = end_time - start_time
+
+        if datname=='trn':
+            yerr, pre, recall, f1 = self.reporter.report_yerr(dset, pred)
+        else:
+            yerr, pre, recall, f1 = self.reporter.report(dset, pred)
+        etimes[datname] = time.time() - start_time
+
+        better = f1 > dbests[datname][1]
+        if better:
+            dbests[datname] = (e,f1)
+            if argsd['save'] and datname == 'dev': # save model to file
+                rnn_param_values = rdnn.get_param_values()
+                save_bundle('{}/{}'.format(MODEL_DIR, argsd['save']), argsd, rnn_param_values,
+                        self.reporter.feat, self.reporter.tdecoder, self.dset.charrep)
+
+        self.log_eval(datname, e, mcost, mtime, yerr, pre, recall, f1, dbests[datname][1], dbests[datname][0])
+        return better
 
 
 
@@ -216,34 +265,56 @@ def setup_logger(args):
     for k,v in sorted(args.iteritems()):
         logger.info('{}:\t{}'.format(k,v))
     logger.info('{}:\t{}'.format('base_log_name',base_log_name))
+    return base_log_name
 
 def main():
     args = get_args()
-    setup_logger(args)
+    base_log_name = setup_logger(args)
+    prof.enable(args['prof'])
 
     dset = Dset(**args)
-    feat = featchar.Feat(args['feat'])
-    feat.fit(dset)
-
-    batcher = Batcher(args['n_batch'], feat)
-    reporter = Reporter(dset, feat)
-
-    validator = Validator(dset, batcher, reporter)
+    bundle = load_bundle(args['load']) if args['load'] else None
+    if bundle and bundle['feat']: # fitted when the model was saved
+        feat = bundle['feat']
+    else:
+        feat = featchar.Feat(args['feat'])
+        feat.fit(dset)
+
+    ids = args['ids'] and feat.compiled
+    if args['ids'] and not feat.compiled:
+        logging.info('feat {} can not be compiled, using dense inputs'.format(args['feat']))
+    batcher = Batcher(args['n_batch'], feat, ids, args['batching'], args['max_chars'], args['bucket_width'], theano.config.floatX)
+    tdecoder = decoder.get_decoder(dset.level, feat, dset.trn, bundle and bundle['transition_tensor'])
+    reporter = Reporter(dset.level, feat, tdecoder)
+
+    validator = Validator(dset, batcher, reporter, args['bcache'], args['prefetch'], args['trn_eval'], args['trn_sample'],
+            '{}/{}.jsonl'.format(LOG_DIR, base_log_name))
 
     RNN = RDNN_Dummy if args['rnn'] == 'dummy' else RDNN
-    rdnn = RNN(feat.NC, feat.NF, args)
-    if not args['load'] == '':
-        dat = np.load(args['load'])
-        dat_args = dat['argsd'].tolist()
-        rnn_param_values = dat['rnn_param_values']
+    if args['eval_only']:
+        assert bundle, '--eval_only needs a model to --load'
+        if args['unroll'] < 0:
+            args['unroll'] = int(max(dset.dev.lens.max(), dset.tst.lens.max()))
+        start_time = time.time()
+        rdnn = RNN(feat.NC, feat.NF, args, ftable=feat.ftable if ids else None, predict_only=True)
+        rdnn.set_param_values(bundle['rnn_param_values'])
+        logging.info('predict only net ready in {:.2f} sec, unroll: {}'.format(time.time() - start_time, args['unroll']))
+        validator.evaluate(rdnn, args)
+        return
+
+    rdnn = RNN(feat.NC, feat.NF, args, ftable=feat.ftable if ids else None)
+    if bundle:
+        rnn_param_values = bundle['rnn_param_values']
         params = lasagne.layers.get_all_params(rdnn.layers[-1])
         lasagne.layers.set_all_param_values(rdnn.layers[-1],
                 rnn_param_values[:len(params)])
         logger = logging.getLogger()
         logger.info('Parameters loaded')
 
-
-    validator.validate(rdnn, args)
+    trainer = ParallelTrainer(rdnn, args['workers'], args['sync']) if args['workers'] > 1 else None
+    validator.validate(rdnn, args, trainer)
+    if trainer:
+        trainer.close()
 
 if __name__ == '__main__':
     main()
@@ -1,9 +1,13 @@
-import numpy as np, logging, string
-from utils import DROPSYM
+import numpy as np, logging, string, weakref
+from utils import DROPSYM, WSTART, WEND
 
 from sklearn.feature_extraction import DictVectorizer
 from sklearn.preprocessing import LabelEncoder
 
+# feat funcs that depend only on the element itself, so they can be precomputed per vocabulary entry
+COMPILED_FEATS = ('basic', 'dgen', 'gen', 'cap')
+MAX_FTABLE = 2**25 # max number of floats in the compiled feature table
+MAX_UNSEEN = 2**16 # max number of memoized row ids of elements not seen in compile
 
 class Feat(object):
 
@@ -12,6 +16,7 @@ class Feat(object):
         self.yenc = LabelEncoder()
         self.featfuncs = featstr.split('_')
         self.randemb = {}
+        self.compiled = all(f in COMPILED_FEATS for f in self.featfuncs)
 
     def getcfeat(self, ci, sent):
         d = {}
@@ -21,8 +26,12 @@ class Feat(object):
 
     def fit(self, dset):
         trn = dset.trn
-        self.dvec.fit(self.getcfeat(ci, sent)  for sent in trn for ci,c in enumerate(sent['x']))
-        self.yenc.fit([t for sent in trn for t in sent['y']])
+        if self.compiled: # feats depend only on the element, so distinct elements give the same fit
+            xvocab = trn.vocab('x')[np.unique(trn.col('x'))]
+            self.dvec.fit(self.getcfeat(0, {'x':[c]}) for c in xvocab)
+        else:
+            self.dvec.fit(self.getcfeat(ci, sent) for sent in ({'x':sent['x']} for sent in trn) for ci,c in enumerate(sent['x']))
+        self.yenc.fit(trn.vocab('y')[np.unique(trn.col('y'))].tolist())
         self.feature_names = self.dvec.get_feature_names()
         self.tag_classes = self.yenc.classes_
         logging.info(self.feature_names)
@@ -31,16 +40,111 @@ class Feat(object):
         self.NF = len(self.feature_names)
         self.NC = len(self.tag_classes)
         logging.info('NF: {} NC: {}'.format(self.NF, self.NC))
+        self.corpus_cache = weakref.WeakKeyDictionary()
+        if self.compiled:
+            self.compile(dset)
+
+    def compile(self, dset):
+        """ precompute the feature row of every element seen in trn/dev/tst, rows are deduplicated into ftable """
+        self.cvocab = np.unique(np.concatenate([d.vocab('x')[np.unique(d.col('x'))] for d in (dset.trn, dset.dev, dset.tst)]))
+        if len(self.cvocab) * self.NF > MAX_FTABLE: # e.g. one-hot words
+            self.compiled = False
+            logging.info('feature table too large to compile: {} elements x {} feats'.format(len(self.cvocab), self.NF))
+            return
+        crows = self.dvec.transform([self.getcfeat(0, {'x':[c]}) for c in self.cvocab])
+
+        self.rindex, rows = {}, []
+        for row in [np.zeros(self.NF, dtype=crows.dtype)] + list(crows): # id 0 is the all-zero row
+            if not row.tobytes() in self.rindex:
+                self.rindex[row.tobytes()] = len(rows)
+                rows.append(row)
+        self.ftable = np.array(rows)
+        self.cids = np.array([self.rindex[row.tobytes()] for row in crows], dtype=np.int32)
+        self.unseen = {}
+        logging.info('compiled feature table: {} elements {} rows'.format(len(self.cvocab), len(self.ftable)))
+
+    def get_state(self):
+        """ arrays that restore the fitted feat with set_state, without a pass over the data """
+        state = {'feature_names': np.array(self.feature_names), 'classes': self.yenc.classes_, 'compiled': np.array(self.compiled)}
+        if self.compiled:
+            state.update({'cvocab': self.cvocab, 'cids': self.cids, 'ftable': self.ftable})
+        if len(self.randemb):
+            state.update({'randemb_keys': np.array(self.randemb.keys()), 'randemb_values': np.array(self.randemb.values())})
+        return state
+
+    def set_state(self, state):
+        self.feature_names = state['feature_names'].tolist()
+        self.dvec.feature_names_ = self.feature_names
+        self.dvec.vocabulary_ = dict((fn, i) for i, fn in enumerate(self.feature_names))
+        self.yenc.classes_ = state['classes']
+        self.tag_classes = self.yenc.classes_
+        self.NF = len(self.feature_names)
+        self.NC = len(self.tag_classes)
+        self.corpus_cache = weakref.WeakKeyDictionary()
+        self.compiled = bool(state['compiled'])
+        if self.compiled:
+            self.cvocab, self.cids, self.ftable = state['cvocab'], state['cids'], state['ftable']
+            self.rindex = dict((row.tobytes(), i) for i, row in enumerate(self.ftable))
+            self.unseen = {}
+        if 'randemb_keys' in state:
+            self.randemb = dict(zip(state['randemb_keys'].tolist(), state['randemb_values']))
+        logging.info('NF: {} NC: {}'.format(self.NF, self.NC))
+
+    def get_row_id(self, c):
+        """ row id of an element that was not seen in compile, falls back to the all-zero row if its features are new """
+        if c in self.unseen:
+            return self.unseen[c]
+        row = self.dvec.transform([self.getcfeat(0, {'x':[c]})])[0]
+        rid = self.rindex.get(row.tobytes(), 0)
+        # bounded as the elements come from the input of e.g. a tagger server, the zero row is cheap to recompute
+        if rid and len(self.unseen) < MAX_UNSEEN:
+            self.unseen[c] = rid
+        return rid
+
+    def lookup(self, x):
+        """ row ids of an array of elements """
+        pos = np.searchsorted(self.cvocab, x).clip(max=len(self.cvocab)-1)
+        ids = self.cids[pos]
+        unseen = self.cvocab[pos] != x
+        if unseen.any():
+            ids[unseen] = [self.get_row_id(c) for c in x[unseen]]
+        return ids
+
+    def transform_ids(self, sent):
+        return self.lookup(np.array(sent['x'])) # nchar
+
+    def transform_x(self, sent):
+        if self.compiled:
+            return self.ftable[self.transform_ids(sent)] # nchar x nf
+        return self.dvec.transform([self.getcfeat(ci, sent) for ci,c in enumerate(sent['x'])]) # nchar x nf
 
     def transform(self, sent):
-        Xsent = self.dvec.transform([self.getcfeat(ci, sent) for ci,c in enumerate(sent['x'])]) # nchar x nf
-        ysent = self.one_hot(self.yenc.transform([t for t in sent['y']]), self.NC) # nchar x nc
-        return Xsent, ysent
+        return self.transform_x(sent), self.transform_y(sent)
+
+    def transform_y(self, sent):
+        return self.yenc.transform([t for t in sent['y']]).astype(np.int32) # nchar
+
+    def corpus_ids(self, corpus):
+        """ row ids of the x column of a corpus, looked up once per vocab entry """
+        return self.corpus_col(corpus, 'ids', lambda: self.lookup(corpus.vocab('x'))[corpus.col('x')])
+
+    def corpus_yids(self, corpus):
+        """ label ids of the y column of a corpus """
+        def encode():
+            vocab, classes = corpus.vocab('y'), self.yenc.classes_
+            pos = np.searchsorted(classes, vocab).clip(max=len(classes)-1)
+            vids = np.where(classes[pos] == vocab, pos, -1).astype(np.int32)
+            yids = vids[corpus.col('y')]
+            if (yids < 0).any():
+                raise ValueError('y contains new labels: {}'.format(np.unique(corpus.decoded('y')[yids < 0])))
+            return yids
+        return self.corpus_col(corpus, 'yids', encode)
 
-    def one_hot(self, labels, n_classes):
-        one_hot = np.zeros((labels.shape[0], n_classes)).astype(bool)
-        one_hot[range(labels.shape[0]), labels] = True
-        return one_hot
+    def corpus_col(self, corpus, k, func):
+        cols = self.corpus_cache.setdefault(corpus, {})
+        if not k in cols:
+            cols[k] = func()
+        return cols[k]
 
     def feat_basic(self, ci, sent):
         return {'c': sent['x'][ci]}
@@ -59,7 +163,7 @@ class Feat(object):
         c = sent['x'][ci]
         if c in string.ascii_letters:
             return {'c': c}
-        elif c in (utils.WSTART, utils.WEND):
+        elif c in (WSTART, WEND):
             return {'c': c}
         elif c == ' ':
             return {'c': 'space'}
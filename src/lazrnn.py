@@ -1,5 +1,12 @@
 import lasagne, theano, numpy as np, logging
+import os, sys, hashlib, cPickle
 from theano import tensor as T
+from theano.compile.pfunc import rebuild_collect_shared
+
+from utils import CACHE_DIR
+import prof
+
+FCACHE_VERSION = 2
 
 class Identity(lasagne.init.Initializer):
 
@@ -30,9 +37,41 @@ class LogSoftMerge(lasagne.layers.MergeLayer):
         return input_shapes[0]
 
 
+class FeatLookupLayer(lasagne.layers.Layer):
+    """ expands int32 feature row ids into their dense feature rows inside the graph """
+
+    def __init__(self, incoming, ftable, **kwargs):
+        super(FeatLookupLayer, self).__init__(incoming, **kwargs)
+        # the table is a constant of the graph, not a param, so saved param values stay the same
+        self.ftable = theano.shared(lasagne.utils.floatX(ftable), name='ftable')
+        self.nf = ftable.shape[1]
+
+    def get_output_shape_for(self, input_shape):
+        return input_shape + (self.nf,)
+
+    def get_output_for(self, input, **kwargs):
+        return self.ftable[input]
+
+class FeatEmbeddingLayer(lasagne.layers.Layer):
+    """ same params as a bias-free DenseLayer over dense feature rows, computed as a lookup into ftable.W """
+
+    def __init__(self, incoming, ftable, num_units, W=lasagne.init.GlorotUniform(), **kwargs):
+        super(FeatEmbeddingLayer, self).__init__(incoming, **kwargs)
+        self.ftable = theano.shared(lasagne.utils.floatX(ftable), name='ftable')
+        self.num_units = num_units
+        self.W = self.add_param(W, (ftable.shape[1], num_units), name="W")
+
+    def get_output_shape_for(self, input_shape):
+        return input_shape + (self.num_units,)
+
+    def get_output_for(self, input, **kwargs):
+        return T.dot(self.ftable, self.W)[input]
+
+
 class RDNN_Dummy:
-    def __init__(self, nc, nf, kwargs):
+    def __init__(self, nc, nf, kwargs, ftable=None, predict_only=False):
         self.nc = nc
+        self.train_counts = (0, 0)
 
     def train(self, dsetdat):
         import time
@@ -45,14 +84,19 @@ class RDNN_Dummy:
     def set_param_values(self, values):
         pass
 
+    def reseed(self, seed):
+        pass
+
     def predict(self, dsetdat):
         ecost, rnn_last_predictions = 0, []
-        for Xdset, Xdsetmsk, ydset, ydsetmsk in dsetdat:
+        for Xdset, Xdsetmsk, ydset in dsetdat:
             ecost += 0
-            sentLens = Xdsetmsk.sum(axis=-1)
+            sentLens, mlen = Xdsetmsk.sum(axis=-1), Xdsetmsk.shape[1]
 
-            rnn_last_predictions.append(\
-                    [self.randlogprob(slen, self.nc) for i, slen in enumerate(sentLens)])
+            pred = np.zeros((len(sentLens), mlen, self.nc))
+            for i, slen in enumerate(sentLens):
+                pred[i,:slen,:] = self.randlogprob(slen, self.nc)
+            rnn_last_predictions.append((pred, Xdsetmsk, ydset))
         return ecost, rnn_last_predictions
 
     def randlogprob(self, sent_len, nc):
@@ -64,7 +108,7 @@ class RDNN_Dummy:
     def viterbi(self, dsetdat):
         from viterbi import viterbi_log
         ecost, rnn_last_predictions = 0, []
-        for Xdset, Xdsetmsk, ydset, ydsetmsk in dsetdat:
+        for Xdset, Xdsetmsk, ydset in dsetdat:
             ecost += 0
             pred = np.log(np.random.rand(len(sentLens),mlen,self.nc))
 
@@ -79,11 +123,21 @@ def extract_rnn_params(kwargs):
 class RDNN:
     param_names=['activation','n_hidden','fbmerge','drates','opt','lr','norm','gclip','truncate','recout','in2out','emb','fbias','gnoise','eps']
 
-    def __init__(self, nc, nf, kwargs):
+    def __init__(self, nc, nf, kwargs, ftable=None, predict_only=False):
+        """
+        if ftable is given, inputs are int32 feature row ids into it instead of dense feature rows,
+        if predict_only, only predict_model is compiled and the net can not be trained,
+        kwargs['unroll'] > 0 unrolls the recurrent layers of a predict_only net to that fixed length instead of scanning,
+        kwargs['trn_eval'] == 'train' makes train also count the errors of the dropout-on forward pass in train_counts
+        """
         assert nf; assert nc
         self.kwargs = extract_rnn_params(kwargs)
         for pname in RDNN.param_names:
             setattr(self, pname, kwargs[pname])
+        self.unroll = kwargs.get('unroll', 0) if predict_only else 0
+        self.train_errors = kwargs.get('trn_eval') == 'train'
+        self.train_counts = (0, 0)
+        unroll_scan = self.unroll > 0
         
         self.lr = theano.shared(np.array(self.lr, dtype='float32'), allow_downcast=True)
         self.gclip = False if self.gclip == 0 else self.gclip # mysteriously, we need this line
@@ -108,15 +162,23 @@ class RDNN:
         forget_gate = lambda : lasagne.layers.Gate(W_in=lasagne.init.Orthogonal(), W_hid=lasagne.init.Orthogonal(),
             b=lasagne.init.Constant(self.fbias))"""
 
-        l_in = lasagne.layers.InputLayer(shape=(None, None, nf))
+        if ftable is None:
+            l_in = lasagne.layers.InputLayer(shape=(None, self.unroll or None, nf))
+            N_BATCH_VAR, MAX_SEQ_LEN_VAR, _ = l_in.input_var.shape # symbolic ref to input_var shape
+        else:
+            l_in = lasagne.layers.InputLayer(shape=(None, self.unroll or None), input_var=T.imatrix('ids'))
+            N_BATCH_VAR, MAX_SEQ_LEN_VAR = l_in.input_var.shape
         logging.debug('l_in: {}'.format(lasagne.layers.get_output_shape(l_in)))
-        N_BATCH_VAR, MAX_SEQ_LEN_VAR, _ = l_in.input_var.shape # symbolic ref to input_var shape
         # l_mask = lasagne.layers.InputLayer(shape=(N_BATCH_VAR, MAX_SEQ_LEN_VAR))
-        l_mask = lasagne.layers.InputLayer(shape=(None, None))
+        l_mask = lasagne.layers.InputLayer(shape=(None, self.unroll or None))
         logging.debug('l_mask: {}'.format(lasagne.layers.get_output_shape(l_mask)))
 
         curlayer = l_in
-        if self.emb:
+        if self.emb and ftable is not None:
+            l_emb = FeatEmbeddingLayer(l_in, ftable, self.emb)
+            logging.debug('l_emb: {}'.format(lasagne.layers.get_output_shape(l_emb)))
+            curlayer = l_emb
+        elif self.emb:
             l_reshape = lasagne.layers.ReshapeLayer(l_in, (-1, nf))
             logging.debug('l_reshape: {}'.format(lasagne.layers.get_output_shape(l_reshape)))
             l_emb = lasagne.layers.DenseLayer(l_reshape, num_units=self.emb, nonlinearity=None, b=None)
@@ -124,6 +186,10 @@ class RDNN:
             l_emb = lasagne.layers.ReshapeLayer(l_emb, (N_BATCH_VAR, MAX_SEQ_LEN_VAR, self.emb))
             logging.debug('l_emb: {}'.format(lasagne.layers.get_output_shape(l_emb)))
             curlayer = l_emb
+        elif ftable is not None:
+            l_lookup = FeatLookupLayer(l_in, ftable)
+            logging.debug('l_lookup: {}'.format(lasagne.layers.get_output_shape(l_lookup)))
+            curlayer = l_lookup
 
         if self.drates[0] > 0:
             l_in_drop = lasagne.layers.DropoutLayer(curlayer, p=self.drates[0])
@@ -139,21 +205,21 @@ class RDNN:
                 elif ltype == 'lrelu': nonlin = lasagne.nonlinearities.leaky_rectify
                 elif ltype == 'relu6': nonlin = lambda x: T.min(lasagne.nonlinearities.rectify(x), 6)
                 elif ltype == 'elu': nonlin = lambda x: T.switch(x >= 0, x, T.exp(x) - 1)
-                l_forward = LayerType(prev_layer, n_hidden, mask_input=l_mask, grad_clipping=self.gclip, gradient_steps=self.truncate,
+                l_forward = LayerType(prev_layer, n_hidden, mask_input=l_mask, grad_clipping=self.gclip, gradient_steps=self.truncate, unroll_scan=unroll_scan,
                         W_hid_to_hid=Identity(), W_in_to_hid=lasagne.init.GlorotUniform(gain='relu'), nonlinearity=nonlin)
-                l_backward = LayerType(prev_layer, n_hidden, mask_input=l_mask, grad_clipping=self.gclip, gradient_steps=self.truncate,
+                l_backward = LayerType(prev_layer, n_hidden, mask_input=l_mask, grad_clipping=self.gclip, gradient_steps=self.truncate, unroll_scan=unroll_scan,
                         W_hid_to_hid=Identity(), W_in_to_hid=lasagne.init.GlorotUniform(gain='relu'), nonlinearity=nonlin, backwards=True)
             elif ltype == 'lstm':
                 LayerType = lasagne.layers.LSTMLayer
                 l_forward = LayerType(prev_layer, n_hidden, ingate=default_gate(),
-                    forgetgate=forget_gate(), outgate=default_gate(), mask_input=l_mask, grad_clipping=self.gclip, gradient_steps=self.truncate)
+                    forgetgate=forget_gate(), outgate=default_gate(), mask_input=l_mask, grad_clipping=self.gclip, gradient_steps=self.truncate, unroll_scan=unroll_scan)
                 l_backward = LayerType(prev_layer, n_hidden, ingate=default_gate(),
-                    forgetgate=forget_gate(), outgate=default_gate(), mask_input=l_mask, grad_clipping=self.gclip, gradient_steps=self.truncate, backwards=True)
+                    forgetgate=forget_gate(), outgate=default_gate(), mask_input=l_mask, grad_clipping=self.gclip, gradient_steps=self.truncate, unroll_scan=unroll_scan, backwards=True)
 
             elif ltype == 'gru':
                 LayerType = lasagne.layers.GRULayer
-                l_forward = LayerType(prev_layer, n_hidden, mask_input=l_mask, grad_clipping=self.gclip, gradient_steps=self.truncate)
-                l_backward = LayerType(prev_layer, n_hidden, mask_input=l_mask, grad_clipping=self.gclip, gradient_steps=self.truncate, backwards=True)
+                l_forward = LayerType(prev_layer, n_hidden, mask_input=l_mask, grad_clipping=self.gclip, gradient_steps=self.truncate, unroll_scan=unroll_scan)
+                l_backward = LayerType(prev_layer, n_hidden, mask_input=l_mask, grad_clipping=self.gclip, gradient_steps=self.truncate, unroll_scan=unroll_scan, backwards=True)
 
             logging.debug('l_forward: {}'.format(lasagne.layers.get_output_shape(l_forward)))
             logging.debug('l_backward: {}'.format(lasagne.layers.get_output_shape(l_backward)))
@@ -174,15 +240,15 @@ class RDNN:
 
         if self.recout == 1:
             logging.info('using recout:%d.'%self.recout)
-            l_out = lasagne.layers.RecurrentLayer(l_fbmerge, num_units=nc, mask_input=l_mask, W_hid_to_hid=Identity(),
+            l_out = lasagne.layers.RecurrentLayer(l_fbmerge, num_units=nc, mask_input=l_mask, unroll_scan=unroll_scan, W_hid_to_hid=Identity(),
                     W_in_to_hid=lasagne.init.GlorotUniform(), nonlinearity=log_softmax)
                     # W_in_to_hid=lasagne.init.GlorotUniform(), nonlinearity=lasagne.nonlinearities.softmax) CHANGED
             logging.debug('l_out: {}'.format(lasagne.layers.get_output_shape(l_out)))
         elif self.recout == 2:
             logging.info('using recout:%d.'%self.recout)
-            l_fout = lasagne.layers.RecurrentLayer(l_fbmerge, num_units=nc, mask_input=l_mask, W_hid_to_hid=Identity(),
+            l_fout = lasagne.layers.RecurrentLayer(l_fbmerge, num_units=nc, mask_input=l_mask, unroll_scan=unroll_scan, W_hid_to_hid=Identity(),
                     W_in_to_hid=lasagne.init.GlorotUniform(), nonlinearity=log_softmax)
-            l_bout = lasagne.layers.RecurrentLayer(l_fbmerge, num_units=nc, mask_input=l_mask, W_hid_to_hid=Identity(),
+            l_bout = lasagne.layers.RecurrentLayer(l_fbmerge, num_units=nc, mask_input=l_mask, unroll_scan=unroll_scan, W_hid_to_hid=Identity(),
                     W_in_to_hid=lasagne.init.GlorotUniform(), nonlinearity=log_softmax, backwards=True)
             l_out = lasagne.layers.ElemwiseSumLayer([l_fout, l_bout], coeffs=0.5)
             # l_out = LogSoftMerge([l_fout, l_bout])
@@ -198,19 +264,31 @@ class RDNN:
 
         self.l_soft_out = l_rec_out
         self.output_layer = l_out
+        self.srngs = [l._srng for l in lasagne.layers.get_all_layers(l_out) if isinstance(l, lasagne.layers.DropoutLayer)]
 
-        target_output = T.tensor3('target_output')
-        out_mask = T.tensor3('mask')
+        target_output = T.imatrix('target_output') # int labels, padded
+        out_mask = l_mask.input_var
 
         """
         def cost(output):
             return -T.sum(out_mask*target_output*T.log(output))/T.sum(out_mask)
         """
         def cost(output): # expects log softmax output
-            return -T.sum(out_mask*target_output*output)/T.sum(out_mask)
+            target_logprobs = output.reshape((-1, nc))[T.arange(target_output.size), target_output.flatten()]
+            # nc keeps the scale of the former one-hot target / nc-wide mask cost
+            return -T.sum(out_mask.flatten()*target_logprobs)/(T.sum(out_mask)*nc)
 
-        cost_train = cost(lasagne.layers.get_output(l_out, deterministic=False))
         cost_eval = cost(lasagne.layers.get_output(l_out, deterministic=True))
+        if predict_only:
+            logging.info("Compiling predict function...")
+            self.predict_model = cached_function('predict_model', self.function_key(nc, nf, ftable is not None), kwargs.get('fcache', 0),
+                    inputs=[l_in.input_var, target_output, l_mask.input_var],
+                    outputs=[cost_eval, lasagne.layers.get_output(l_out, deterministic=True)])
+            logging.info("Compiling done.")
+            return
+
+        out_train = lasagne.layers.get_output(l_out, deterministic=False)
+        cost_train = cost(out_train)
 
 
         all_params = lasagne.layers.get_all_params(l_out, trainable=True)
@@ -228,6 +306,7 @@ class RDNN:
         if self.gnoise:
             from theano.tensor.shared_randomstreams import RandomStreams
             srng = RandomStreams(seed=1234)
+            self.srngs.append(srng)
             e_prev = theano.shared(lasagne.utils.floatX(0.))
             nu = 0.01
             gamma = 0.55
@@ -238,36 +317,72 @@ class RDNN:
             updates = self.opt(all_grads, all_params, self.lr, self.eps)
         
 
+        fkey, fcache = self.function_key(nc, nf, ftable is not None), kwargs.get('fcache', 0)
         logging.info("Compiling functions...")
-        self.train_model = theano.function(inputs=[l_in.input_var, target_output, l_mask.input_var, out_mask], outputs=cost_train, updates=updates, allow_input_downcast=True)
-        self.predict_model = theano.function(
-                inputs=[l_in.input_var, target_output, l_mask.input_var, out_mask],
+        if self.train_errors: # error and token counts of the same forward pass
+            outputs_train = [cost_train, T.sum(out_mask*T.neq(T.argmax(out_train, axis=-1), target_output)), T.sum(out_mask)]
+        else:
+            outputs_train = cost_train
+        self.train_model = cached_function('train_model', fkey, fcache,
+                inputs=[l_in.input_var, target_output, l_mask.input_var], outputs=outputs_train, updates=updates, allow_input_downcast=True)
+        self.predict_model = cached_function('predict_model', fkey, fcache,
+                inputs=[l_in.input_var, target_output, l_mask.input_var],
                 outputs=[cost_eval, lasagne.layers.get_output(l_out, deterministic=True)])
+        logging.info("Compiling done.")
 
-        # aux
-        self.train_model_debug = theano.function(
-                inputs=[l_in.input_var, target_output, l_mask.input_var, out_mask],
+        # aux, compiled on first use
+        self.aux = {
+            'train_model_debug': lambda: theano.function(
+                inputs=[l_in.input_var, target_output, l_mask.input_var],
                 outputs=[cost_train]+lasagne.layers.get_output([l_out, l_fbmerge], deterministic=True)+[total_norm],
-                updates=updates)
-        self.compute_cost = theano.function([l_in.input_var, target_output, l_mask.input_var, out_mask], cost_eval)
-        self.compute_cost_train = theano.function([l_in.input_var, target_output, l_mask.input_var, out_mask], cost_train)
+                updates=updates),
+            'compute_cost': lambda: theano.function([l_in.input_var, target_output, l_mask.input_var], cost_eval),
+            'compute_cost_train': lambda: theano.function([l_in.input_var, target_output, l_mask.input_var], cost_train),
+        }
         # self.info_model = theano.function([],recout_hid2hid)
-        logging.info("Compiling done.")
+
+    def __getattr__(self, name):
+        aux = self.__dict__.get('aux', {})
+        if name in aux:
+            logging.info("Compiling {}...".format(name))
+            self.__dict__[name] = aux.pop(name)()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def function_key(self, nc, nf, ids):
+        """ everything the compiled graphs depend on, param values are not part of it """
+        # lr is a shared variable and fbias only initializes a param, the cached graph links to their current values
+        graph_kwargs = sorted((k, v) for k, v in self.kwargs.items() if k not in ('lr', 'fbias'))
+        return repr((FCACHE_VERSION, graph_kwargs, self.unroll, self.train_errors, nc, nf, ids, theano.__version__, lasagne.__version__,
+            theano.config.floatX, theano.config.device, theano.config.mode, theano.config.optimizer, theano.config.cxx))
 
     def train(self, dsetdat):
-        tcost = np.mean([self.train_model(Xdset, ydset, Xdsetmsk, ydsetmsk) for Xdset, Xdsetmsk, ydset, ydsetmsk in dsetdat])
+        outs = []
+        for Xdset, Xdsetmsk, ydset in dsetdat:
+            with prof.timer('train_model', Xdsetmsk.sum(), len(Xdsetmsk)):
+                outs.append(self.train_model(Xdset, ydset, Xdsetmsk))
+        if self.train_errors:
+            outs = np.array(outs)
+            self.train_counts = tuple(int(c) for c in outs[:,1:].sum(axis=0))
+            return np.mean(outs[:,0])
+        tcost = np.mean(outs)
         # pcost, pred = self.predict(dsetdat)
         return tcost
 
 
     def predict(self, dsetdat):
         bcosts, rnn_last_predictions = [], []
-        for Xdset, Xdsetmsk, ydset, ydsetmsk in dsetdat:
-            bcost, pred = self.predict_model(Xdset, ydset, Xdsetmsk, ydsetmsk)
+        for Xdset, Xdsetmsk, ydset in dsetdat:
+            with prof.timer('predict_model', Xdsetmsk.sum(), len(Xdsetmsk)):
+                if self.unroll: # the unrolled graph takes exactly unroll steps
+                    mlen = Xdsetmsk.shape[1]
+                    bcost, pred = self.predict_model(*[pad_steps(a, self.unroll) for a in (Xdset, ydset, Xdsetmsk)])
+                    pred = pred[:,:mlen]
+                else:
+                    bcost, pred = self.predict_model(Xdset, ydset, Xdsetmsk)
             bcosts.append(bcost)
             # predictions = np.argmax(pred*ydsetmsk, axis=-1).flatten()
-            sentLens, mlen = Xdsetmsk.sum(axis=-1), Xdset.shape[1]
-            rnn_last_predictions.append([pred[i,0:slen,:] for i, slen in enumerate(sentLens)])
+            rnn_last_predictions.append((pred, Xdsetmsk, ydset))
         return np.mean(bcosts), rnn_last_predictions
 
     def get_param_values(self):
@@ -279,6 +394,63 @@ class RDNN:
     def set_param_values(self, values):
         lasagne.layers.set_all_param_values(self.output_layer, values)
 
+    def reseed(self, seed):
+        """ reseeds the dropout and gradient noise streams, forked replicas would draw the same masks otherwise """
+        rng = np.random.RandomState(seed)
+        for srng in self.srngs:
+            srng.seed(rng.randint(1, 2**30))
+
+def pad_steps(a, n):
+    """ zero pads axis 1 of a batch array up to n steps """
+    if a.shape[1] > n:
+        raise ValueError('a batch of {} steps does not fit into {} unrolled steps'.format(a.shape[1], n))
+    padding = [(0,0)] * a.ndim
+    padding[1] = (0, n - a.shape[1])
+    return np.pad(a, padding, 'constant')
+
+def cached_function(name, key, fcache=True, inputs=None, outputs=None, updates=None, **kwargs):
+    """
+    theano.function that is pickled to the cache dir after compiling, a later run with the same key
+    unpickles the optimized graph and links it to the shared variables (params, optimizer state, rngs) of the current graph
+    """
+    if not fcache:
+        return theano.function(inputs, outputs, updates=updates, **kwargs)
+    fname = '{}/rdnn-{}-{}.pkl'.format(CACHE_DIR, name, hashlib.md5(key).hexdigest())
+    recursion_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(recursion_limit, 100000)) # scan graphs are deep
+    try:
+        if os.path.exists(fname):
+            try:
+                with open(fname, 'rb') as f:
+                    maker = cPickle.load(f)
+                # shared variables in the order theano.function appends them to the inputs
+                shared = rebuild_collect_shared(outputs if isinstance(outputs, list) else [outputs], inputs,
+                        updates=updates, rebuild_strict=True, copy_inputs_over=True)[2][3]
+                cached_shared = [i.variable for i in maker.inputs[len(inputs):]]
+                if len(shared) == len(cached_shared) and all(s1.type == s2.type for s1, s2 in zip(shared, cached_shared)):
+                    logging.info('{} loaded from {}'.format(name, fname))
+                    return maker.create([None]*len(inputs) + [s.container for s in shared]) # linked to the storage of the current shared variables
+                logging.warning('{} in {} does not match the graph, compiling'.format(name, fname))
+            except Exception as e:
+                logging.warning('can not load {} from {}: {}'.format(name, fname, e))
+
+        func = theano.function(inputs, outputs, updates=updates, **kwargs)
+        tmp = '{}.{}.tmp'.format(fname, os.getpid()) # renamed when complete, concurrent runs never read a partial file
+        try:
+            if not os.path.exists(CACHE_DIR):
+                os.makedirs(CACHE_DIR)
+            with open(tmp, 'wb') as f:
+                cPickle.dump(func.maker, f, protocol=cPickle.HIGHEST_PROTOCOL) # the optimized graph, linked again on load
+            os.rename(tmp, fname)
+            logging.info('{} saved to {}'.format(name, fname))
+        except Exception as e:
+            logging.warning('can not save {} to {}: {}'.format(name, fname, e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return func
+    finally:
+        sys.setrecursionlimit(recursion_limit)
+
 if __name__ == '__main__':
     import exper
     parser = exper.get_arg_parser()
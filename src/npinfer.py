@@ -0,0 +1,154 @@
+""" forward pass of the nets lazrnn.RDNN builds, in numpy only, from their saved param values """
+import numpy as np
+
+import prof
+
+def sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+def log_softmax(x):
+    xdev = x - x.max(-1, keepdims=True)
+    return xdev - np.log(np.sum(np.exp(xdev), axis=-1, keepdims=True))
+
+NONLINS = {
+    'relu': lambda x: np.maximum(x, 0),
+    'lrelu': lambda x: np.where(x > 0, x, .01 * x), # lasagne leaky_rectify
+    'relu6': lambda x: np.minimum(np.maximum(x, 0), 6),
+    'elu': lambda x: np.where(x >= 0, x, np.exp(np.minimum(x, 0)) - 1),
+}
+
+class RDNN_Numpy(object):
+    """
+    predict only RDNN, param values are taken in the order of lasagne.layers.get_all_params of the RDNN,
+    the gate params are stacked as in the lasagne layers so each step is a single dot per direction
+    """
+
+    def __init__(self, nc, nf, kwargs, ftable=None, predict_only=True):
+        if kwargs.get('recout'):
+            raise ValueError('recurrent output layers are not supported by the numpy rnn')
+        self.nc, self.nf = nc, nf
+        self.ftable = ftable
+        self.emb = kwargs['emb']
+        self.in2out = kwargs['in2out']
+        self.fbmerge = kwargs['fbmerge']
+        self.n_hidden = kwargs['n_hidden']
+        self.deep_ltypes = [kwargs['activation'].split('-')[1]] * len(self.n_hidden)
+        for ltype in self.deep_ltypes:
+            if ltype not in NONLINS and ltype not in ('lstm', 'gru'):
+                raise ValueError('unknown layer type: {}'.format(ltype))
+        self.values = None
+        self.train_counts = (0, 0)
+
+    def get_param_values(self):
+        return self.values
+
+    def set_param_values(self, values):
+        self.values = list(values)
+        vals = iter([np.asarray(v) for v in values])
+        take = lambda *shape: expect(next(vals, None), shape)
+
+        nin = self.nf
+        self.W_emb = None
+        if self.emb:
+            self.W_emb = take(nin, self.emb)
+            nin = self.emb
+        # the ids of a batch index the (embedded) rows of ftable
+        self.xtable = None if self.ftable is None else np.asarray(self.ftable.dot(self.W_emb) if self.emb else self.ftable, dtype=np.float32)
+        ninput = nin
+
+        self.blayers = []
+        for ltype, nh in zip(self.deep_ltypes, self.n_hidden):
+            self.blayers.append(tuple(self.layer_params(ltype, nin, nh, take) for backwards in (False, True)))
+            nin = nh * (2 if self.fbmerge == 'concat' else 1)
+        nout = nin + (ninput if self.in2out else 0)
+        self.W_out, self.b_out = take(nout, self.nc), take(self.nc)
+        if next(vals, None) is not None:
+            raise ValueError('more param values than the params of the net')
+
+    def layer_params(self, ltype, nin, nh, take):
+        """ (W_in, W_hid, b, extra) with the gates stacked in the order the step slices them """
+        if ltype == 'lstm': # ingate, forgetgate, cell, outgate; peepholes; cell_init, hid_init
+            gates = [(take(nin, nh), take(nh, nh), take(nh)) for g in range(4)]
+            peeps = [take(nh) for g in range(3)]
+            cell_init, hid_init = take(1, nh), take(1, nh)
+            W_in, W_hid, b = [np.concatenate(ws, axis=-1) for ws in zip(*gates)]
+            return W_in, W_hid, b, (peeps, cell_init, hid_init)
+        elif ltype == 'gru': # updategate, resetgate, hidden_update; hid_init, stacked as reset, update, hidden
+            update, reset, hidden = [(take(nin, nh), take(nh, nh), take(nh)) for g in range(3)]
+            hid_init = take(1, nh)
+            W_in, W_hid, b = [np.concatenate(ws, axis=-1) for ws in zip(reset, update, hidden)]
+            return W_in, W_hid, b, hid_init
+        else: # hid_init, W_in_to_hid, b, W_hid_to_hid
+            hid_init = take(1, nh)
+            W_in, b = take(nin, nh), take(nh)
+            W_hid = take(nh, nh)
+            return W_in, W_hid, b, hid_init
+
+    def forward(self, X, mask):
+        """ log probs of a padded batch, nsent x maxlen x nc """
+        mask = mask.astype(bool)
+        if self.ftable is not None:
+            x = self.xtable[X]
+        elif self.emb:
+            x = np.dot(X, self.W_emb)
+        else:
+            x = X
+        h = x
+        for ltype, layers in zip(self.deep_ltypes, self.blayers):
+            hs = [self.recurrent(ltype, params, h, mask, backwards) for params, backwards in zip(layers, (False, True))]
+            h = np.concatenate(hs, axis=-1) if self.fbmerge == 'concat' else hs[0] + hs[1]
+        if self.in2out:
+            h = np.concatenate([h, x], axis=-1)
+        return log_softmax(np.dot(h, np.asarray(self.W_out)) + self.b_out)
+
+    def recurrent(self, ltype, params, x, mask, backwards=False):
+        """ a masked recurrent layer over all steps, masked steps keep the previous state """
+        W_in, W_hid, b, extra = params
+        W_in, W_hid = np.asarray(W_in), np.asarray(W_hid) # quantized weights are dequantized once per batch
+        nsent, nstep = mask.shape
+        nh = W_hid.shape[0]
+        xs = np.dot(x, W_in) + b # input part of all steps at once
+        out = np.empty((nsent, nstep, nh), dtype=xs.dtype)
+        if ltype == 'lstm':
+            (p_in, p_forget, p_out), cell_init, hid_init = extra
+            cell, hid = np.repeat(cell_init, nsent, axis=0), np.repeat(hid_init, nsent, axis=0)
+        else:
+            hid = np.repeat(extra, nsent, axis=0)
+        for t in (range(nstep)[::-1] if backwards else range(nstep)):
+            m = mask[:, t, None]
+            hid_in = np.dot(hid, W_hid)
+            if ltype == 'lstm':
+                gates = xs[:, t] + hid_in
+                ingate = sigmoid(gates[:, :nh] + cell * p_in)
+                forgetgate = sigmoid(gates[:, nh:2*nh] + cell * p_forget)
+                cell_new = forgetgate * cell + ingate * np.tanh(gates[:, 2*nh:3*nh])
+                outgate = sigmoid(gates[:, 3*nh:] + cell_new * p_out)
+                hid_new = outgate * np.tanh(cell_new)
+                cell = np.where(m, cell_new, cell)
+            elif ltype == 'gru':
+                resetgate = sigmoid(xs[:, t, :nh] + hid_in[:, :nh])
+                updategate = sigmoid(xs[:, t, nh:2*nh] + hid_in[:, nh:2*nh])
+                hidden_update = np.tanh(xs[:, t, 2*nh:] + resetgate * hid_in[:, 2*nh:]) # the reset gate only scales the hidden part
+                hid_new = (1 - updategate) * hid + updategate * hidden_update
+            else:
+                hid_new = NONLINS[ltype](xs[:, t] + hid_in)
+            hid = np.where(m, hid_new, hid)
+            out[:, t] = hid
+        return out
+
+    def predict(self, dsetdat):
+        bcosts, rnn_last_predictions = [], []
+        for Xdset, Xdsetmsk, ydset in dsetdat:
+            with prof.timer('predict_numpy', Xdsetmsk.sum(), len(Xdsetmsk)):
+                pred = self.forward(Xdset, Xdsetmsk)
+                target_logprobs = pred.reshape(-1, self.nc)[np.arange(ydset.size), ydset.ravel()].reshape(ydset.shape)
+                bcosts.append(-np.sum(Xdsetmsk * target_logprobs) / (np.sum(Xdsetmsk) * self.nc))
+            rnn_last_predictions.append((pred, Xdsetmsk, ydset))
+        return np.mean(bcosts), rnn_last_predictions
+
+def expect(value, shape):
+    if value is None:
+        raise ValueError('fewer param values than the params of the net')
+    if value.shape != shape:
+        raise ValueError('param of shape {} where {} is expected'.format(value.shape, shape))
+    return value
@@ -0,0 +1,143 @@
+import os, time
+import logging
+import itertools
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+
+class ParallelTrainer(object):
+    """
+    data parallel training with forked replicas of rdnn, each worker trains on its own batches,
+    every sync batches per worker the params of the workers are averaged through shared memory
+    """
+
+    def __init__(self, rdnn, nworkers, sync=1):
+        self.rdnn = rdnn
+        self.nworkers = nworkers
+        self.sync = sync
+        self.train_counts = (0, 0)
+        self.nsent, self.ttrain, self.twait = 0, 0., 0.
+
+        values = rdnn.get_param_values()
+        self.shapes = [v.shape for v in values]
+        dtype = values[0].dtype if len(values) else np.float32
+        nparam = sum(v.size for v in values)
+        # row 0 holds the averaged params, row w the params of worker w after its last round
+        buf = RawArray('b', max((nworkers+1) * nparam * np.dtype(dtype).itemsize, 1))
+        self.slots = np.frombuffer(buf, dtype=dtype, count=(nworkers+1) * nparam).reshape(nworkers+1, nparam)
+
+        self.conns, self.procs = [], []
+        for w in range(1, nworkers+1): # forked after compiling, the replicas reuse the compiled functions
+            conn, child_conn = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=work, args=(rdnn, self.slots, w, child_conn, self.shapes))
+            proc.daemon = True
+            proc.start()
+            self.conns.append(conn); self.procs.append(proc)
+        logging.info('{} training workers, params averaged every {} batches, {} params'.format(nworkers, sync, nparam))
+
+    def train(self, dsetdat):
+        """ same as rdnn.train, the params of rdnn are the averaged ones afterwards """
+        start_time = time.time()
+        self.slots[0] = flatten(self.rdnn.get_param_values())
+        batches = iter(dsetdat)
+        costs, counts = [], np.zeros(2, dtype=np.int64)
+        while True:
+            active = []
+            for w, conn in enumerate(self.conns, 1):
+                rbatches = list(itertools.islice(batches, self.sync))
+                if not len(rbatches):
+                    break
+                conn.send(rbatches)
+                active.append(w)
+                self.nsent += sum(len(Xmsk) for X, Xmsk, y in rbatches)
+            if not len(active):
+                break
+            wait_time = time.time()
+            for w in active:
+                cost, nbatch, wcounts = self.conns[w-1].recv()
+                costs.extend([cost] * nbatch); counts += wcounts
+            self.twait += time.time() - wait_time
+            self.slots[0] = self.slots[active].mean(axis=0)
+        self.rdnn.set_param_values(unflatten(self.slots[0], self.shapes))
+        self.train_counts = tuple(counts)
+        self.ttrain += time.time() - start_time
+        return np.mean(costs)
+
+    def throughput(self):
+        """ trained sents per sec and the share of the time spent waiting for the slowest worker """
+        return self.nsent / max(self.ttrain, 1e-6), self.twait / max(self.ttrain, 1e-6)
+
+    def reset_stats(self):
+        self.nsent, self.ttrain, self.twait = 0, 0., 0.
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(None)
+        for proc in self.procs:
+            proc.join()
+
+def work(rdnn, slots, w, conn, shapes):
+    """ worker loop, trains its replica from the averaged params on the batches of each round """
+    rdnn.reseed(1234 + w) # a replica forks the dropout rngs of rdnn, each needs its own masks
+    while True:
+        batches = conn.recv()
+        if batches is None:
+            break
+        rdnn.set_param_values(unflatten(slots[0], shapes))
+        cost = rdnn.train(batches)
+        slots[w] = flatten(rdnn.get_param_values())
+        conn.send((cost, len(batches), rdnn.train_counts))
+
+def flatten(values):
+    return np.concatenate([v.ravel() for v in values]) if len(values) else np.zeros(0)
+
+def unflatten(flat, shapes):
+    values, start = [], 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        values.append(flat[start:start+size].reshape(shape).copy())
+        start += size
+    return values
+
+def scaling(rdnn, batches, max_workers, sync=1):
+    """ throughput of training on the same batches with 1 to max_workers workers, efficiency is relative to 1 worker """
+    results = []
+    for nworkers in range(1, max_workers+1):
+        trainer = ParallelTrainer(rdnn, nworkers, sync)
+        trainer.train(batches[:nworkers*sync]) # warm up
+        trainer.reset_stats()
+        trainer.train(batches)
+        sps, wait = trainer.throughput()
+        trainer.close()
+        results.append((nworkers, sps, sps / (nworkers * results[0][1]) if results else 1., wait))
+        logging.info('{:<5} workers: {:<3d} sents/sec: {:>10.2f} efficiency: {:.3f} wait: {:.3f}'.format('scale', *results[-1]))
+    return results
+
+def main():
+    import theano
+    import exper, featchar
+    from dataset import Dset
+    from lazrnn import RDNN, RDNN_Dummy
+    from utils import logger
+
+    parser = exper.get_arg_parser()
+    parser.add_argument("--bench_batches", default=64, type=int, help="num of trn batches to train on for each num of workers")
+    args = exper.get_args(parser)
+    logger()
+    if os.environ.get('MKL_NUM_THREADS') is None and os.environ.get('OMP_NUM_THREADS') is None:
+        logging.warning('set MKL_NUM_THREADS/OMP_NUM_THREADS, the blas threads of the workers compete for the cores otherwise')
+
+    dset = Dset(**args)
+    feat = featchar.Feat(args['feat'])
+    feat.fit(dset)
+    ids = args['ids'] and feat.compiled
+    batcher = exper.Batcher(args['n_batch'], feat, ids, args['batching'], args['max_chars'], args['bucket_width'], theano.config.floatX)
+    trndat = exper.BatchStream(batcher, dset.trn, ncache=0)
+    batches = list(trndat.iter_plan(trndat.shuffled_plan()[:args['bench_batches']]))
+
+    RNN = RDNN_Dummy if args['rnn'] == 'dummy' else RDNN
+    rdnn = RNN(feat.NC, feat.NF, args, ftable=feat.ftable if ids else None)
+    scaling(rdnn, batches, max(args['workers'], 1), args['sync'])
+
+if __name__ == '__main__':
+    main()
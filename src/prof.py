@@ -0,0 +1,59 @@
+""" named stage timers and counters, timer returns a shared no-op context when profiling is off """
+import time
+import logging
+from collections import OrderedDict
+
+ENABLED = False
+STATS = OrderedDict() # name: [calls, secs, chars, sents]
+
+class NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL = NullTimer()
+
+class Timer(object):
+    __slots__ = ('stat', 'start')
+
+    def __init__(self, stat):
+        self.stat = stat
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.stat[0] += 1
+        self.stat[1] += time.time() - self.start
+        return False
+
+def enable(on=True):
+    global ENABLED
+    ENABLED = bool(on)
+
+def timer(name, nchar=0, nsent=0):
+    """ with timer('stage', nchar, nsent): ... adds the time and the processed chars and sents to the stage """
+    if not ENABLED:
+        return NULL
+    stat = STATS.get(name)
+    if stat is None:
+        stat = STATS[name] = [0, 0., 0, 0]
+    stat[2] += nchar
+    stat[3] += nsent
+    return Timer(stat)
+
+def report(prefix='prof', e=0, reset=True):
+    """ logs calls, secs, chars/sec and sents/sec of each stage, returns the stats as dicts """
+    rows = []
+    for name, (calls, secs, nchar, nsent) in STATS.iteritems():
+        rows.append({'stage': name, 'calls': calls, 'secs': secs,
+            'chars_sec': nchar / secs if secs > 0 else 0., 'sents_sec': nsent / secs if secs > 0 else 0.})
+        logging.info('{:<5} {:<5d} {:<12} calls: {:>7d} secs: {:>10.4f} chars/sec: {:>12.1f} sents/sec: {:>10.1f}'.format(
+            prefix, e, name, calls, secs, rows[-1]['chars_sec'], rows[-1]['sents_sec']))
+    if reset:
+        STATS.clear()
+    return rows
@@ -0,0 +1,136 @@
+""" post-training weight quantization of the numpy rnn, calibrated and scored on the dev split """
+import os, sys, json, time, copy
+import ctypes, subprocess
+import logging
+import argparse
+import random, numpy as np
+from tabulate import tabulate
+
+from dataset import Dset
+from batching import BatchStream
+from bench import mem_kb
+
+QMODES = ['int8', 'float16']
+
+class Quantized(object):
+    """ weight matrix kept as int8 with per column scales or as float16, dequantized to float32 by np.asarray """
+
+    def __init__(self, W, mode='int8', clip=1.):
+        self.shape = W.shape
+        if mode == 'int8':
+            # symmetric, the scale of a column covers the clip quantile of its abs values, larger ones saturate
+            amax = np.percentile(np.abs(W), clip * 100, axis=0) if clip < 1 else np.abs(W).max(axis=0)
+            self.scale = (np.maximum(amax, 1e-8) / 127.).astype(np.float32)
+            self.data = np.clip(np.round(W / self.scale), -127, 127).astype(np.int8)
+        elif mode == 'float16':
+            self.scale = None
+            self.data = W.astype(np.float16)
+        else:
+            raise ValueError('unknown quantization mode: {}'.format(mode))
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + (self.scale.nbytes if self.scale is not None else 0)
+
+    def __array__(self, dtype=None):
+        W = self.data.astype(np.float32)
+        if self.scale is not None:
+            W *= self.scale
+        return W if dtype is None else W.astype(dtype)
+
+def quantize_net(net, mode='int8', clip=1.):
+    """
+    copy of an RDNN_Numpy with its recurrent input and hidden matrices and its output matrix quantized,
+    biases, peepholes and inits stay float32, the matrices are dequantized once per layer and batch,
+    the float param values are not kept so the copy can replace net
+    """
+    qnet = copy.copy(net)
+    qnet.values = None
+    qnet.blayers = [tuple((Quantized(W_in, mode, clip), Quantized(W_hid, mode, clip), b, extra) for W_in, W_hid, b, extra in layers)
+            for layers in net.blayers]
+    qnet.W_out = Quantized(net.W_out, mode, clip)
+    return qnet
+
+def release_heap():
+    """ hands the freed float weights back to the os, glibc keeps them in the heap of the process otherwise """
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError): # not glibc
+        pass
+
+def weight_bytes(net):
+    Ws = [W for layers in net.blayers for W_in, W_hid, b, extra in layers for W in (W_in, W_hid)] + [net.W_out]
+    return sum(W.nbytes for W in Ws)
+
+def evaluate(net, stream, reporter):
+    """ mean cost, f1 and sents/sec of net on a batch stream """
+    start_time = time.time()
+    mcost, pred = net.predict(stream)
+    sps = len(stream.sents) / max(time.time() - start_time, 1e-6)
+    yerr, pre, recall, f1 = reporter.report(stream.sents, pred)
+    return mcost, f1, sps
+
+def calibrate(net, stream, mode, clips):
+    """ clip quantile with the lowest cost on the calibration stream, float16 needs none """
+    if mode != 'int8':
+        return None
+    costs = [(quantize_net(net, mode, clip).predict(stream)[0], clip) for clip in clips]
+    for cost, clip in costs:
+        logging.info('calib {} clip: {:.4f} cost: {:.6f}'.format(mode, clip, cost))
+    return min(costs)[1]
+
+def get_args():
+    parser = argparse.ArgumentParser(prog="quantize")
+
+    parser.add_argument("model", help="model file saved by exper with --save, absolute or relative to the models dir")
+    parser.add_argument("--modes", default=QMODES, nargs='+', choices=QMODES, help="quantizations to compare with the float model")
+    parser.add_argument("--clips", default=[1., .9999, .999, .99], type=float, nargs='+', help="per column abs value quantiles tried as int8 ranges")
+    parser.add_argument("--calib", default=500, type=int, help="num of random dev sents to calibrate on")
+    parser.add_argument("--n_batch", default=0, type=int, help="batch size, 0: the one of the model")
+    parser.add_argument("--child", default='', help=argparse.SUPPRESS) # mode of a tagger whose rss is measured, internal
+    parser.add_argument("--qclip", default=1., type=float, help=argparse.SUPPRESS)
+
+    return vars(parser.parse_args())
+
+def tagger_rss(args, mode, clip):
+    """ rss in kB of a new process holding a tagger of the model in mode, the json on its last line """
+    out = subprocess.check_output([sys.executable, os.path.abspath(__file__), args['model'], '--n_batch', str(args['n_batch']),
+        '--child', mode, '--qclip', str(clip or 1.)])
+    return json.loads(out.strip().splitlines()[-1])['rss_kb']
+
+def main():
+    from tagger import Tagger
+
+    args = get_args()
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler(sys.stderr))
+    if args['child']:
+        tagger = Tagger(args['model'], 'numpy', args['n_batch'], quant='' if args['child'] == 'float32' else args['child'], qclip=args['qclip'])
+        print json.dumps({'rss_kb': mem_kb('VmRSS')})
+        return
+
+    tagger = Tagger(args['model'], 'numpy', args['n_batch'])
+    net, batcher, reporter = tagger.rdnn, tagger.batcher, tagger.reporter
+    random.seed(7)
+    dset = Dset(**tagger.argsd)
+    calib = dset.dev.take(sorted(random.sample(xrange(len(dset.dev)), min(args['calib'], len(dset.dev)))))
+    streams = [BatchStream(batcher, d, ncache=-1) for d in (calib, dset.dev, dset.tst)]
+
+    rows = []
+    for mode in ['float32'] + args['modes']:
+        if mode == 'float32':
+            qnet, clip = net, None
+        else:
+            clip = calibrate(net, streams[0], mode, args['clips'])
+            qnet = quantize_net(net, mode, clip)
+        (dcost, df1, dsps), (tcost, tf1, tsps) = [evaluate(qnet, stream, reporter) for stream in streams[1:]]
+        rss = tagger_rss(args, mode, clip) / 1024.
+        rows.append([mode, clip, weight_bytes(qnet) / 1024., rss, dcost, df1, tf1, (dsps + tsps) / 2])
+        logging.info('{:<8} clip: {} dev f1: {:.2f} tst f1: {:.2f} tagger rss: {:.1f} MB'.format(mode, clip, df1, tf1, rss))
+    for row in rows:
+        row.append(row[5] - rows[0][5])
+    print tabulate(rows, headers=['mode', 'clip', 'weights KB', 'tagger rss MB', 'dev cost', 'dev f1', 'tst f1', 'sents/sec', 'dev f1 diff'], floatfmt='.4f')
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 from itertools import chain, groupby, izip
 from collections import Counter
+import numpy as np
 
 import utils
 
@@ -94,29 +95,35 @@ def get_ts_io(wiseq, tseq):
     tseqgrp = [[tseq[ti] for ti in ts] for ts in tgroup]
     return [Counter(tseq1).most_common(1)[0][0].upper() for tseq1 in tseqgrp]
 
-def get_ts_bio(wiseq, tseq):
+def get_ts_bio(wiseq, tseq, offsets=None):
 # def get_ts():
     """
     cseq = ['a','b','c',' ','d','e']
     wiseq = [0,0,0,-1,1,1]
     tseq = ['i-per', 'i-per', 'i-per', 'o', 'i-per', 'i-per']
+
+    wiseq and tseq can be the flat columns of many sents where sent i spans offsets[i]:offsets[i+1],
+    then the word tags of all sents are returned as a flat array
     """
-    # print tabulate([cseq,wiseq,tseq])
-    windxs = [group.next()[1] for k, group in groupby(((wi,i) for i, wi in enumerate(wiseq) if wi > -1), lambda x:x[0])]
-    ts = []
-    for i in windxs:
-        if tseq[i] == 'o':
-            ts.append('O')
-        else:
-            ttype = tseq[i].split('-')[1]
-            if i == 0:
-                ts.append('B-{}'.format(ttype.upper()))
-            else:
-                if tseq[i-1] == tseq[i]:
-                    ts.append('I-{}'.format(ttype.upper()))
-                else:
-                    ts.append('B-{}'.format(ttype.upper()))
-    return ts
+    flat = offsets is not None
+    wiseq, tseq = np.asarray(wiseq), np.asarray(tseq)
+    offsets = np.asarray(offsets) if flat else np.array([0, len(wiseq)])
+    sids = np.repeat(np.arange(len(offsets)-1), np.diff(offsets))
+    sstart = np.zeros(len(wiseq), dtype=bool)
+    sstart[offsets[:-1][np.diff(offsets) > 0]] = True
+
+    # first char of each word
+    cis = np.flatnonzero(wiseq > -1)
+    wfirst = np.ones(len(cis), dtype=bool)
+    wfirst[1:] = (wiseq[cis[1:]] != wiseq[cis[:-1]]) | (sids[cis[1:]] != sids[cis[:-1]])
+    windxs = cis[wfirst]
+
+    t = tseq[windxs]
+    tprev = tseq[np.maximum(windxs-1, 0)]
+    ttype = np.char.upper(np.char.partition(t, '-')[:,2])
+    begins = sstart[windxs] | (tprev != t)
+    ts = np.where(t == 'o', 'O', np.where(begins, np.char.add('B-', ttype), np.char.add('I-', ttype)))
+    return ts if flat else ts.tolist()
 
 def is_consec(sent):
     return any(t1.startswith('I-') and t2.startswith('B-') and t1.split('-')[1] == t2.split('-')[1]
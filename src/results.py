@@ -1,4 +1,5 @@
 import argparse
+import ast, json, os
 from utils import ROOT_DIR
 from os import walk
 import pandas as pd
@@ -9,6 +10,15 @@ import traceback
 from tabulate import tabulate
 
 LOG_DIR = '{}/logs'.format(ROOT_DIR)
+INDEX_FILE = '{}/results-index.json'.format(LOG_DIR)
+INDEX_VERSION = 1
+
+PARAMS = ["feat", "rep", "activation", "n_hidden", "fbmerge", "drates",
+    "recout", "opt", "lr", "norm", "n_batch", "fepoch", "in2out", "emb",
+    "lang", "reverse", "tagging", "shuf"]
+DEFAULTS = {"feat": "basic_seg", "rep": "std", "fbmerge": "concat", "in2out": 0, "emb": 0,
+    "lang": "eng", "reverse": False, "tagging": "io", "shuf": 0}
+LCOLS = ['epoch', 'mcost', 'mtime', 'yerr', 'pre', 'recall', 'f1', 'best', 'best_epoch']
 
 def get_arg_parser():
     parser = argparse.ArgumentParser(prog="results")
@@ -17,7 +27,7 @@ def get_arg_parser():
         choices=['lang_results', 'lang_best_plot'], help = "job choice")
     parser.add_argument("--lang", default='eng',
         choices=['eng', 'deu', 'spa', 'ned', 'tr', 'cze'], help ='language choice')
-    
+
     return parser
 
 def get_lines(all_lines, pattern):
@@ -29,21 +39,14 @@ def get_lines(all_lines, pattern):
 
     return lines
 
-def get_experiment_frame(lines):
-    df = pd.DataFrame(columns=['epoch', 'mcost', 'mtime', 'cerr', 'werr', 'wacc',
-        'precision', 'recall', 'f1', 'best', 'best_epoch'])
-    for i in range(len(lines)):
-        df.loc[i] = map(float, lines[i].split()[1:])
-
-    return df
-
-def get_lang(lines):
-    lang = "eng"
-    for l in lines:
-        if "lang" in l:
-            lang = l.strip().split()[-1]
-            break
-    return lang
+def get_experiment_log(lines):
+    """ columns of the epoch lines of a dset in an info log, older logs have werr and wacc after cerr """
+    if not len(lines): # no evals of the dset, e.g. tst with --tst_best before the first dev improvement
+        return dict((c, []) for c in LCOLS)
+    rows = np.array([map(float, line.split()[1:]) for line in lines]).reshape(len(lines), -1)
+    if rows.shape[1] == 11: # epoch mcost mtime cerr werr wacc precision recall f1 best best_epoch
+        rows = rows[:, [0,1,2,3,6,7,8,9,10]]
+    return dict((c, rows[:,i].tolist()) for i, c in enumerate(LCOLS))
 
 def get_params(lines):
     param_dict = {}
@@ -56,156 +59,121 @@ def get_params(lines):
     #print param_dict
     return param_dict
 
-def get_an_entry(params, trn_df, dev_df, tst_df, fname):
-    entry = []
-
-    if "feat" in params:
-        entry.append(params["feat"])
-    else:
-        entry.append("basic_seg")
-    
-    if "rep" in params:
-        entry.append(params["rep"])
-    else:
-        entry.append("std")
-    
-    if params["activation"].startswith("["):
-        entry.append(eval(params["activation"]))
-    else:
-        entry.append(params["activation"])
-    entry.append(eval(params["n_hidden"]))
-
-    if "fbmerge" in params:
-        entry.append(params["fbmerge"])
-    else:
-        entry.append("concat")
-
-    entry.append(eval(params["drates"]))
-    entry.append(eval(params["recout"]))
-    entry.append(params["opt"])
-    entry.append(float(params["lr"]))
-    entry.append(float(params["norm"]))
-    entry.append(int(params["n_batch"]))
-    entry.append(int(params["fepoch"]))
-
-    if "in2out" in params:
-        entry.append(int(params["in2out"]))
-    else:
-        entry.append(0)
-
-    if "emb" in params:
-        entry.append(int(params["emb"]))
-    else:
-        entry.append(0)
-
-    if "lang" in params:
-        entry.append(params["lang"])
-    else:
-        entry.append("eng")
-
-    if "reverse" in params:
-        entry.append(params["reverse"] == "True")
-    else:
-        entry.append(False)
-
-    if "tagging" in params:
-        entry.append(params["tagging"])
-    else:
-        entry.append("io")
-
-    trn_best = trn_df.ix[trn_df["best"].idxmax()]
-    dev_best = dev_df.ix[dev_df["best"].idxmax()]
-
-    entry.append(trn_best['cerr'])
-    entry.append(trn_best['werr'])
-    entry.append(trn_best['f1'])
-    entry.append(dev_best['cerr'])
-    entry.append(dev_best['werr'])
-    entry.append(dev_best['f1'])
-
-    if tst_df is None:
-        entry.append(100)
-        entry.append(100)
-        entry.append(0)
-    else:
-        tst_at_dev_best = len(np.unique(dev_df["best"]))
-        
-        tst_best = tst_df.ix[tst_at_dev_best - 1]
-    
-        entry.append(tst_best['cerr'])
-        entry.append(tst_best['werr'])
-        entry.append(tst_best['f1'])
-
-    entry.append(trn_best['mcost'])
-    entry.append(dev_best['best_epoch'])
-    entry.append(trn_best['mtime'])
-    entry.append(trn_df["epoch"].max())
-    entry.append(fname)
-
-    if "shuf" in params:
-        entry.append(int(params["shuf"]))
-    else:
-        entry.append(0)
-
-    entry.append(trn_df)
-    entry.append(dev_df)
-    entry.append(tst_df)
-
+def parse_value(v):
+    try:
+        return ast.literal_eval(v)
+    except (ValueError, SyntaxError):
+        return v
+
+def read_info(fname):
+    """ params and per dset logs of an info log """
+    with open(fname) as f:
+        lines = f.readlines()
+    params = dict((k, parse_value(v)) for k, v in get_params(lines).iteritems())
+    logs = dict((dname, get_experiment_log(get_lines(lines, dname + ' '))) for dname in ('trn', 'dev', 'tst'))
+    return params, logs
+
+def read_metrics(fname):
+    """ params and per dset logs of a metrics json lines file written by exper, with the nupdate of each eval """
+    params, logs = {}, dict((dname, dict((c, []) for c in LCOLS + ['nupdate'])) for dname in ('trn', 'dev', 'tst'))
+    with open(fname) as f:
+        for line in f:
+            row = json.loads(line)
+            if 'args' in row:
+                params = row['args'] or {}
+            elif row.get('dset') in logs and 'best' in row:
+                for c in LCOLS + ['nupdate']:
+                    logs[row['dset']][c].append(row[c])
+    return params, logs
+
+def get_an_entry(params, logs, fname):
+    """ one row of the results table, the logs are kept as column lists """
+    entry = dict((p, params.get(p, DEFAULTS.get(p))) for p in PARAMS)
+    trn, dev, tst = logs['trn'], logs['dev'], logs['tst']
+    if not len(dev['epoch']):
+        return None
+
+    ibest = lambda log: int(np.argmax(log['best'])) if len(log['best']) else None
+    itrn, idev = ibest(trn), ibest(dev)
+    best_epoch = dev['best_epoch'][idev]
+    # tst of the eval with the best dev f1, or the last tst before it when tst was not evaluated then,
+    # evals are told apart by nupdate as an epoch has several with --eval_updates, info logs only have the epoch
+    key = 'nupdate' if 'nupdate' in dev else 'epoch'
+    itst = np.searchsorted(tst[key], dev[key][idev], side='right') - 1 if len(tst[key]) else -1
+
+    for dname, log, i in (('trn', trn, itrn), ('dev', dev, idev), ('tst', tst, itst if itst >= 0 else None)):
+        entry[dname+'-yerr'] = log['yerr'][i] if i is not None else 100
+        entry[dname+'-f1'] = log['f1'][i] if i is not None else 0
+    entry['trn-cost'] = trn['mcost'][itrn] if itrn is not None else None
+    entry['trn-time'] = trn['mtime'][itrn] if itrn is not None else None
+    entry['best-epoch'] = best_epoch
+    entry['best-nupdate'] = dev['nupdate'][idev] if key == 'nupdate' else None
+    entry['max-epoch'] = max(dev['epoch'])
+    entry['log_fname'] = fname
+    for dname in ('trn', 'dev', 'tst'):
+        entry[dname+'_log'] = logs[dname]
     return entry
 
-def collect():
-    cols = ["feat", "rep", "activation", "n_hidden", "fbmerge", "drates",
-        "recout", "opt", "lr", "norm", "n_batch", "fepoch", "in2out", "emb",
-        "lang", "reverse", "tagging", "trn-cerr", "trn-werr", "trn-f1",
-        "dev-cerr", "dev-werr", "dev-f1", "tst-cerr", "tst-werr", "tst-f1",
-        "trn-cost", "best-epoch", "trn-time", "max-epoch", "log_fname", "shuf",
-        "trn_log", "dev_log", "tst_log"]
-    
+def load_index():
     try:
-        all_results = pd.read_json('all_results.json')
-    except:
-        all_results = pd.DataFrame(columns=cols)
-
+        with open(INDEX_FILE) as f:
+            index = json.load(f)
+        return index['runs'] if index.get('version') == INDEX_VERSION else {}
+    except (IOError, ValueError, KeyError):
+        return {}
+
+def save_index(runs):
+    tmp = '{}.{}.tmp'.format(INDEX_FILE, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump({'version': INDEX_VERSION, 'runs': runs}, f)
+    os.rename(tmp, INDEX_FILE)
+
+def run_files():
+    """ the metrics file of each run, the info log for runs without one """
     files = []
     for (_, _, fnames) in walk(LOG_DIR):
         files += fnames
+        break
+    metrics = set(f[:-len('.jsonl')] for f in files if f.endswith('.jsonl') and not f.startswith('sweep-'))
+    infos = set(f[:-len('.info')] for f in files if f.endswith('.info'))
+    return sorted([b + '.jsonl' for b in metrics] + [b + '.info' for b in infos - metrics])
 
-    files = filter(lambda s: s.endswith("info"), files)
+def collect():
+    """ ingests only the runs that are new or changed since the last collect, the table is built in one step """
+    runs = load_index()
+    files = run_files()
+
+    nnew = 0
+    for indx, fname in enumerate(files, 1):
+        path = LOG_DIR + "/" + fname
+        st = os.stat(path)
+        stamp = [st.st_mtime, st.st_size]
+        if fname in runs and runs[fname]['stamp'] == stamp:
+            continue
 
-    i = all_results.shape[0]
-    indx = 0
-    for fname in files:
-        indx += 1
-        if fname in all_results['log_fname'].values.tolist():
-            break
-        
         print "Processing: {} / {}\r".format(indx, len(files)),
         sys.stdout.flush()
-        with open(LOG_DIR + "/" + fname, 'r') as f:
-            try:
-                lines = f.readlines()
-
-                params_dict = get_params(lines)
-                #print params_dict
-
-                trn_lines = get_lines(lines, "trn ")
-                dev_lines = get_lines(lines, "dev")
-                tst_lines = get_lines(lines, "tst")
-            
-                trn_df = get_experiment_frame(trn_lines)
-                dev_df = get_experiment_frame(dev_lines)
-                tst_df = None if len(tst_lines) == 0 else get_experiment_frame(tst_lines)
-                
-                all_results.loc[i] = get_an_entry(params_dict, trn_df, dev_df, tst_df, fname)
-
-                i += 1
-                
-            except Exception as e:
-                print "Error during processing file: " + fname
-                print e
-                traceback.print_exc()
-
-    all_results.to_json('all_results.json')
+        try:
+            params, logs = read_metrics(path) if fname.endswith('.jsonl') else read_info(path)
+            runs[fname] = {'stamp': stamp, 'entry': get_an_entry(params, logs, fname)}
+            nnew += 1
+        except Exception as e:
+            print "Error during processing file: " + fname
+            print e
+            traceback.print_exc()
+
+    current = set(files)
+    nrun = len(runs)
+    runs = dict((f, r) for f, r in runs.iteritems() if f in current) # logs that were removed
+    if nnew or len(runs) != nrun:
+        save_index(runs)
+    print "{} runs, {} ingested".format(len(runs), nnew)
+
+    entries = [runs[f]['entry'] for f in sorted(runs) if runs[f]['entry'] is not None]
+    all_results = pd.DataFrame(entries)
+    for dname in ('trn', 'dev', 'tst'):
+        if dname+'_log' in all_results:
+            all_results[dname+'_log'] = all_results[dname+'_log'].map(pd.DataFrame)
     return all_results
 
 def show_best_results(df):
@@ -213,7 +181,7 @@ def show_best_results(df):
 
     print tabulate(df[g['dev-f1'].transform(max) == df['dev-f1']][['lang',
         'dev-f1', 'tst-f1']].values, headers=["lang", "dev", "tst"])
-    
+
     print "\n**** Files ****"
     print tabulate(df[g['dev-f1'].transform(max) == df['dev-f1']][['lang',
         'log_fname']].values, headers=["lang", "fname"])
@@ -227,11 +195,11 @@ def plot_lang_best(df, lang):
     plt.xlabel('epoch')
     #plt.ylabel('f1')
     plt.plot(trn['epoch'], trn['f1'], label ='trn f1')
-    plt.plot(trn['epoch'], dev['f1'], label = 'dev f1')
-    plt.plot(trn['epoch'], (1 - trn['cerr']) * 100, label='trn char acc')
-    plt.plot(trn['epoch'], (1 - dev['cerr']) * 100, label='dev char acc')
+    plt.plot(dev['epoch'], dev['f1'], label = 'dev f1')
+    plt.plot(trn['epoch'], (1 - trn['yerr']) * 100, label='trn char acc')
+    plt.plot(dev['epoch'], (1 - dev['yerr']) * 100, label='dev char acc')
     plt.legend(bbox_to_anchor=(1.0001, 1), loc=2, borderaxespad=0.)
-    plt.show()    
+    plt.show()
 
 if __name__ == "__main__":
     parser = get_arg_parser()
@@ -242,4 +210,4 @@ if __name__ == "__main__":
         show_best_results(df)
     elif args['job'] == "lang_best_plot":
         plot_lang_best(df, args['lang'])
-        
+
@@ -0,0 +1,151 @@
+""" time and peak rss of each stage of the dset to metrics pipeline on synthetic datasets of growing size """
+import os, sys, json, time, shutil, subprocess
+import logging
+import argparse
+import random, numpy as np
+from tabulate import tabulate
+
+from bench import mem_kb, reset_peak
+from syngen import gen_dset
+from utils import DATA_DIR, LOG_DIR, SRC_DIR, logger
+
+STAGES = ['dset', 'feat', 'batch', 'train', 'eval']
+
+def get_args():
+    parser = argparse.ArgumentParser(prog="scaling")
+
+    parser.add_argument("--name", default='scale', help="name of the json and png written to the logs dir")
+    parser.add_argument("--sizes", default=[10**4, 10**5, 10**6, 10**7], type=int, nargs='+', help="num of trn words of each run")
+    parser.add_argument("--lens", default='poisson', choices=['poisson', 'lognormal', 'uniform', 'fixed'], help="sent length distribution, see syngen")
+    parser.add_argument("--mean_words", default=12, type=float, help="mean num of words of a sent, the max for uniform")
+    parser.add_argument("--sigma", default=1., type=float, help="sigma of lognormal sent lengths")
+    parser.add_argument("--nalpha", default=26, type=int, help="num of distinct letters (NF-1)")
+    parser.add_argument("--ntype", default=4, type=int, help="num of entity types (NC-1)")
+    parser.add_argument("--keep", default=0, type=int, help="keep the generated datasets in the data dir")
+
+    parser.add_argument("--feat", default='basic', help="feat string, as in exper")
+    parser.add_argument("--n_batch", default=32, type=int, help="batch size")
+    parser.add_argument("--captrn", default=0, type=int, help="ignore trn sents with more chars than this, 0: keep all")
+    parser.add_argument("--epochs", default=1, type=int, help="num of training epochs")
+    parser.add_argument("--rnn", default='dummy', choices=['dummy','lazrnn'], help="dummy: RDNN_Dummy stands in, its train is a sleep per epoch")
+    parser.add_argument("--rnn_args", default='', help="exper args of the lazrnn net, e.g. '--activation bi-lstm --n_hidden 128'")
+    parser.add_argument("--child", default='', help=argparse.SUPPRESS) # lang of a single run, internal
+
+    return vars(parser.parse_args())
+
+class Stages(object):
+    """ secs, peak rss growth and rss after each stage of a run """
+
+    def __init__(self):
+        self.rows = []
+
+    def run(self, name, func, *fargs):
+        reset_peak()
+        rss, start_time = mem_kb('VmRSS'), time.time()
+        result = func(*fargs)
+        self.rows.append({'stage': name, 'secs': time.time() - start_time,
+            'peak_mb': max(mem_kb('VmHWM') - rss, 0) / 1024., 'rss_mb': mem_kb('VmRSS') / 1024.})
+        logging.info('{:<6} {:>10.2f} secs peak: {:>9.1f} MB rss: {:>9.1f} MB'.format(name, *[self.rows[-1][k] for k in ('secs', 'peak_mb', 'rss_mb')]))
+        return result
+
+def run_pipeline(args):
+    """ all stages of one run in this process, the stage rows are printed as json on the last line """
+    from dataset import Dset
+    import featchar, decoder
+    from batching import Batcher, BatchStream, Reporter
+    random.seed(7)
+    np.random.seed(7)
+
+    stages = Stages()
+    dset = stages.run('dset', lambda: Dset(lang=args['child'], captrn=args['captrn'], dcache=False))
+    feat = featchar.Feat(args['feat'])
+    stages.run('feat', feat.fit, dset)
+    ids = feat.compiled
+    batcher = Batcher(args['n_batch'], feat, ids)
+
+    def batch():
+        nbatch = 0
+        for b in BatchStream(batcher, dset.trn, ncache=0):
+            nbatch += 1
+        return nbatch
+    stages.run('batch', batch)
+
+    if args['rnn'] == 'lazrnn':
+        import exper
+        from lazrnn import RDNN
+        argsd = vars(exper.get_arg_parser().parse_args(args['rnn_args'].split()))
+        argsd['drates'] = argsd['drates'] if any(argsd['drates']) else [0]*(len(argsd['n_hidden'])+1)
+        rdnn = RDNN(feat.NC, feat.NF, argsd, ftable=feat.ftable if ids else None)
+    else:
+        from lazrnn import RDNN_Dummy
+        rdnn = RDNN_Dummy(feat.NC, feat.NF, {})
+    trndat = BatchStream(batcher, dset.trn, ncache=0)
+    stages.run('train', lambda: [rdnn.train(trndat.iter_plan(trndat.shuffled_plan())) for e in range(args['epochs'])])
+
+    reporter = Reporter(dset.level, feat, decoder.get_decoder(dset.level, feat, dset.trn))
+    def evaluate():
+        devdat = BatchStream(batcher, dset.dev, ncache=0)
+        mcost, pred = rdnn.predict(devdat)
+        return reporter.report(devdat.sents, pred)
+    stages.run('eval', evaluate)
+
+    info = {'trn_sents': len(dset.trn), 'trn_chars': int(dset.trn.lens.sum()), 'max_len': int(dset.trn.lens.max()), 'NF': feat.NF, 'NC': feat.NC}
+    print json.dumps({'info': info, 'stages': stages.rows})
+
+def plot(rows, fname):
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        logging.warning('no matplotlib, {} is not plotted'.format(fname))
+        return
+    fig, axes = plt.subplots(1, 2, figsize=(12, 5))
+    for ax, k, ylabel in zip(axes, ('secs', 'peak_mb'), ('secs', 'peak rss growth MB')):
+        for stage in STAGES:
+            pts = sorted((r['tokens'], r[k]) for r in rows if r['stage'] == stage)
+            ax.plot([p[0] for p in pts], [max(p[1], 1e-3) for p in pts], marker='o', label=stage)
+        ax.set_xscale('log'); ax.set_yscale('log')
+        ax.set_xlabel('trn words'); ax.set_ylabel(ylabel)
+        ax.legend(loc=2)
+    fig.savefig(fname, bbox_inches='tight')
+    logging.info('plotted to {}'.format(fname))
+
+def main():
+    args = get_args()
+    logger()
+    if args['child']:
+        run_pipeline(args)
+        return
+
+    rows = []
+    gen_args = dict((k, args[k]) for k in ('lens', 'mean_words', 'sigma', 'nalpha', 'ntype'))
+    child_args = ['--feat', args['feat'], '--n_batch', str(args['n_batch']), '--captrn', str(args['captrn']),
+        '--epochs', str(args['epochs']), '--rnn', args['rnn'], '--rnn_args', args['rnn_args']]
+    for tokens in args['sizes']:
+        lang = '{}-{}'.format(args['name'], tokens)
+        start_time = time.time()
+        gen_dset(lang, tokens, **gen_args)
+        logging.info('{} generated in {:.1f} sec'.format(lang, time.time() - start_time))
+        try: # a process per size, so the rss of a run starts from scratch
+            out = subprocess.check_output([sys.executable, '{}/scaling.py'.format(SRC_DIR), '--child', lang] + child_args)
+        except subprocess.CalledProcessError as e:
+            logging.error('{} failed with status {}'.format(lang, e.returncode))
+            break
+        finally:
+            if not args['keep']:
+                shutil.rmtree('{}/{}'.format(DATA_DIR, lang))
+        run = json.loads(out.strip().splitlines()[-1])
+        logging.info('{} {}'.format(lang, run['info']))
+        for r in run['stages']:
+            rows.append(dict(r, tokens=tokens, **run['info']))
+
+    fname = '{}/scaling-{}'.format(LOG_DIR, args['name'])
+    with open(fname + '.json', 'w') as f:
+        json.dump({'args': args, 'results': rows}, f, indent=1, sort_keys=True)
+    print tabulate([[r['tokens'], r['trn_chars'], r['stage'], r['secs'], r['peak_mb'], r['rss_mb']] for r in rows],
+        headers=['words', 'chars', 'stage', 'secs', 'peak MB', 'rss MB'], floatfmt='.2f')
+    plot(rows, fname + '.png')
+
+if __name__ == '__main__':
+    main()
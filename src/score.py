@@ -1,13 +1,116 @@
 import re, subprocess
+import numpy as np
 from utils import SRC_DIR
 
 
 def conlleval(ts_gold, ts_pred):
-    text = ''
+    tags, gold, pred, offsets = encode_tags(ts_gold, ts_pred)
+    counts = conlleval_ids(gold, pred, tags, offsets)
+    return conll_scores(counts), conll_text(counts)
+
+def conlleval_flat(ts_gold, ts_pred, offsets):
+    """ ts_gold and ts_pred are flat tag arrays of all sents, sent i spans offsets[i]:offsets[i+1] """
+    tags, ids = np.unique(np.concatenate((ts_gold, ts_pred)), return_inverse=True)
+    counts = conlleval_ids(ids[:len(ts_gold)], ids[len(ts_gold):], tags.tolist(), np.asarray(offsets))
+    return conll_scores(counts), conll_text(counts)
+
+def encode_tags(ts_gold, ts_pred):
+    """ flattens the tag sequences into int arrays over a shared tag list, sentence i spans offsets[i]:offsets[i+1] """
+    tindx = {}
+    gold, pred, offsets = [], [], [0]
     for ts1, ts2 in zip(ts_gold, ts_pred):
         for t1, t2 in zip(ts1, ts2):
-            text += 'x x x %s %s\n'%(t1,t2)
-        text += '\n'
+            gold.append(tindx.setdefault(t1, len(tindx)))
+            pred.append(tindx.setdefault(t2, len(tindx)))
+        offsets.append(len(gold))
+    tags = sorted(tindx, key=tindx.get)
+    return tags, np.array(gold, dtype=np.int32), np.array(pred, dtype=np.int32), np.array(offsets)
+
+def conlleval_ids(gold, pred, tags, offsets):
+    """ same chunk semantics as the conlleval script, gold and pred are int arrays indexing tags """
+    tprefixes, ttypes = zip(*[t.split('-', 1) if '-' in t else (t, '') for t in tags])
+    types = sorted(set(ttypes) | set(['']))
+    tprefix = np.array(list(tprefixes) + ['O']) # last entry is the sentence boundary tag
+    ttype = np.array([types.index(tt) for tt in list(ttypes) + ['']])
+
+    # a boundary token after each sentence, like the empty lines fed to the script
+    nsent = len(offsets) - 1
+    ntok = len(gold) + nsent
+    is_token = np.ones(ntok, dtype=bool)
+    is_token[offsets[1:] + np.arange(nsent)] = False
+    bound = len(tags)
+
+    counts = {'ntok': len(gold), 'correct_tags': int(np.sum(gold == pred)), 'types': types}
+    chunks = {}
+    for name, ids in (('gold', gold), ('pred', pred)):
+        seq = np.empty(ntok, dtype=np.int32)
+        seq.fill(bound)
+        seq[is_token] = ids
+        prefix, typ = tprefix[seq], ttype[seq]
+        pprefix, ptyp = np.concatenate((['O'], prefix[:-1])), np.concatenate(([ttype[bound]], typ[:-1]))
+
+        end = chunk_end(pprefix, prefix, ptyp, typ)
+        start = chunk_start(pprefix, prefix, ptyp, typ)
+        starts, ends = np.flatnonzero(start), np.flatnonzero(end)
+        # a chunk starting at i ends before the first chunk end flagged after i
+        nexts = np.searchsorted(ends, starts, side='right')
+        stops = np.append(ends, ntok)[nexts]
+        chunks[name] = (starts, stops, typ[starts])
+        counts['found_'+name] = np.bincount(typ[starts], minlength=len(types))
+
+    gstarts, gstops, gtypes = chunks['gold']
+    pstarts, pstops, ptypes = chunks['pred']
+    gkeys = (gstarts * (ntok+1) + gstops) * len(types) + gtypes
+    pkeys = (pstarts * (ntok+1) + pstops) * len(types) + ptypes
+    correct = np.in1d(gkeys, pkeys)
+    counts['correct'] = np.bincount(gtypes[correct], minlength=len(types))
+    return counts
+
+def chunk_end(pprefix, prefix, ptyp, typ):
+    return ((pprefix == 'B') & (prefix == 'B')) | ((pprefix == 'B') & (prefix == 'O')) | \
+        ((pprefix == 'I') & (prefix == 'B')) | ((pprefix == 'I') & (prefix == 'O')) | \
+        ((pprefix == 'E') & (prefix == 'E')) | ((pprefix == 'E') & (prefix == 'I')) | \
+        ((pprefix == 'E') & (prefix == 'O')) | \
+        ((pprefix != 'O') & (pprefix != '.') & (ptyp != typ)) | \
+        (pprefix == ']') | (pprefix == '[')
+
+def chunk_start(pprefix, prefix, ptyp, typ):
+    return ((pprefix == 'B') & (prefix == 'B')) | ((pprefix == 'I') & (prefix == 'B')) | \
+        ((pprefix == 'O') & (prefix == 'B')) | ((pprefix == 'O') & (prefix == 'I')) | \
+        ((pprefix == 'E') & (prefix == 'E')) | ((pprefix == 'E') & (prefix == 'I')) | \
+        ((pprefix == 'O') & (prefix == 'E')) | \
+        ((prefix != 'O') & (prefix != '.') & (ptyp != typ)) | \
+        (prefix == '[') | (prefix == ']')
+
+def prf(correct, found_pred, found_gold):
+    precision = 100.*correct/found_pred if found_pred > 0 else 0.
+    recall = 100.*correct/found_gold if found_gold > 0 else 0.
+    f1 = 2*precision*recall/(precision+recall) if precision+recall > 0 else 0.
+    return precision, recall, f1
+
+def conll_scores(counts):
+    """ accuracy, precision, recall, f1 rounded as printed by the script """
+    acc = 100.*counts['correct_tags']/counts['ntok']
+    precision, recall, f1 = prf(counts['correct'].sum(), counts['found_pred'].sum(), counts['found_gold'].sum())
+    return [float('%.2f'%v) for v in (acc, precision, recall, f1)]
+
+def conll_text(counts):
+    correct, found_pred, found_gold = counts['correct'].sum(), counts['found_pred'].sum(), counts['found_gold'].sum()
+    lines = ['processed %d tokens with %d phrases; found: %d phrases; correct: %d.'%(counts['ntok'], found_gold, found_pred, correct)]
+    if counts['ntok'] > 0:
+        lines.append('accuracy: %6.2f%%; precision: %6.2f%%; recall: %6.2f%%; FB1: %6.2f'%((100.*counts['correct_tags']/counts['ntok'],) + prf(correct, found_pred, found_gold)))
+    for ti in np.argsort(counts['types']):
+        if counts['found_gold'][ti] or counts['found_pred'][ti]:
+            precision, recall, f1 = prf(counts['correct'][ti], counts['found_pred'][ti], counts['found_gold'][ti])
+            lines.append('%17s: precision: %6.2f%%; recall: %6.2f%%; FB1: %6.2f  %d'%(counts['types'][ti], precision, recall, f1, counts['found_pred'][ti]))
+    return '\n'.join(lines) + '\n'
+
+def conlleval_perl(ts_gold, ts_pred):
+    lines = []
+    for ts1, ts2 in zip(ts_gold, ts_pred):
+        lines.extend('x x x %s %s\n'%(t1,t2) for t1, t2 in zip(ts1, ts2))
+        lines.append('\n')
+    text = ''.join(lines)
 
     proc = subprocess.Popen(
         '%s/conlleval'%SRC_DIR,stdout=subprocess.PIPE,
@@ -19,3 +122,22 @@ def conlleval(ts_gold, ts_pred):
     proc.wait()
     return map(float,res), result
 
+def perturb(ts, tags, rng, p=.1):
+    return [tags[rng.randint(len(tags))] if rng.rand() < p else t for t in ts]
+
+if __name__ == '__main__':
+    """ parity check against the conlleval script """
+    from utils import get_sents
+    rng = np.random.RandomState(7)
+    for lang, enc in (('cze', 'utf-8'), ('ned', 'latin1')):
+        trn, dev, tst = get_sents(lang, enc)
+        for dname, dset in (('dev',dev), ('tst',tst)):
+            ts_gold = [sent['ts'] for sent in dset]
+            tags = sorted(set(t for ts in ts_gold for t in ts))
+            for p in (0., .02, .2, 1.):
+                ts_pred = [perturb(ts, tags, rng, p) for ts in ts_gold]
+                res, text = conlleval(ts_gold, ts_pred)
+                res_perl, text_perl = conlleval_perl(ts_gold, ts_pred)
+                assert res == res_perl and text == text_perl, (lang, dname, p, text, text_perl)
+                print lang, dname, p, res
+    print 'conlleval parity ok'
@@ -0,0 +1,135 @@
+import os, sys, glob, json, time
+import logging
+import argparse
+import hashlib
+import random, subprocess
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+from utils import LOG_DIR, SRC_DIR, logger
+
+def get_args():
+    parser = argparse.ArgumentParser(prog="sweep")
+
+    parser.add_argument("spec", help="json file with base: fixed exper args, grid: lists of values to cross, random: value specs to sample ntrial times")
+    parser.add_argument("--name", default='', help="sweep name, default: the spec file name")
+    parser.add_argument("--jobs", default=2, type=int, help="num of trials to run at a time")
+    parser.add_argument("--threads", default=1, type=int, help="blas threads of each trial")
+    parser.add_argument("--dry", default=0, type=int, help="only print the trials to run")
+
+    return vars(parser.parse_args())
+
+def sample_value(spec, rng):
+    """ a list is a choice, {"uniform": [a, b]}, {"loguniform": [a, b]} and {"randint": [a, b]} are ranges """
+    if isinstance(spec, list):
+        return rng.choice(spec)
+    (dist, (a, b)), = spec.items()
+    if dist == 'uniform':
+        return rng.uniform(a, b)
+    elif dist == 'loguniform':
+        return float(np.exp(rng.uniform(np.log(a), np.log(b))))
+    elif dist == 'randint':
+        return rng.randint(a, b)
+    raise ValueError('unknown value spec: {}'.format(spec))
+
+def get_trials(spec):
+    """ exper args of each trial, the grid crossed with ntrial random samples, each on top of base """
+    base, grid, rand = spec.get('base', {}), spec.get('grid', {}), spec.get('random', {})
+    points = [{}]
+    for k in sorted(grid):
+        points = [dict(p, **{k: v}) for p in points for v in grid[k]]
+    rng = random.Random(spec.get('seed', 7))
+    samples = [dict((k, sample_value(rand[k], rng)) for k in sorted(rand)) for i in range(spec.get('ntrial', 1))] if rand else [{}]
+    return [dict(base, **dict(p, **s)) for p in points for s in samples]
+
+def trial_id(params):
+    return hashlib.md5(json.dumps(params, sort_keys=True)).hexdigest()[:8]
+
+def trial_argv(params):
+    argv = []
+    for k, v in sorted(params.items()):
+        if isinstance(v, bool): # store_true flags
+            argv += ['--'+k] if v else []
+        elif isinstance(v, list):
+            argv += ['--'+k] + [str(e) for e in v]
+        else:
+            argv += ['--'+k, str(v)]
+    return argv
+
+def read_results(fname):
+    results = []
+    if os.path.exists(fname):
+        with open(fname) as src:
+            results = [json.loads(l) for l in src if len(l.strip())]
+    return results
+
+def log_scores(logname):
+    """ best dev f1, its eval and the tst f1 of the same eval from the metrics file of a trial """
+    fnames = glob.glob('{}/*,{}.jsonl'.format(LOG_DIR, logname))
+    if not len(fnames):
+        return None
+    rows = {'dev': {}, 'tst': {}} # by nupdate, an epoch has several evals with --eval_updates
+    with open(fnames[0]) as src:
+        for l in src:
+            row = json.loads(l)
+            if row.get('dset') in rows and 'best' in row:
+                rows[row['dset']][row['nupdate']] = row
+    if not len(rows['dev']):
+        return None
+    nupdate = max(sorted(rows['dev']), key=lambda n: rows['dev'][n]['f1']) # first eval with the best f1
+    tst = rows['tst'].get(nupdate, {})
+    return {'dev_f1': rows['dev'][nupdate]['f1'], 'epoch': rows['dev'][nupdate]['epoch'], 'nupdate': nupdate,
+            'tst_f1': tst.get('f1'), 'log': os.path.basename(fnames[0])}
+
+def run_trial(args):
+    """ runs exper.py in its own process with limited blas threads, returns its result entry """
+    name, params, threads = args
+    tid = trial_id(params)
+    logname = '{}-{}'.format(name, tid)
+    env = dict(os.environ, MKL_NUM_THREADS=str(threads), OMP_NUM_THREADS=str(threads), OPENBLAS_NUM_THREADS=str(threads))
+    start_time = time.time()
+    with open('{}/{}.err'.format(LOG_DIR, logname), 'w') as err, open(os.devnull, 'w') as out:
+        status = subprocess.call([sys.executable, '{}/exper.py'.format(SRC_DIR)] + trial_argv(params) + ['--log', logname],
+                env=env, stdout=out, stderr=err)
+    entry = {'id': tid, 'params': params, 'status': status, 'time': time.time() - start_time}
+    entry.update(log_scores(logname) or {})
+    return entry
+
+def main():
+    args = get_args()
+    logger()
+    with open(args['spec']) as src:
+        spec = json.load(src)
+    name = args['name'] or os.path.splitext(os.path.basename(args['spec']))[0]
+    fname = '{}/sweep-{}.jsonl'.format(LOG_DIR, name)
+
+    results = read_results(fname)
+    done = set(r['id'] for r in results if r['status'] == 0)
+    trials = [params for params in get_trials(spec) if trial_id(params) not in done]
+    logging.info('sweep {}: {} trials, {} done, {} to run with {} jobs'.format(name, len(trials) + len(done), len(done), len(trials), args['jobs']))
+    if args['dry']:
+        for params in trials:
+            print trial_id(params), ' '.join(trial_argv(params))
+        return
+
+    best = max([r for r in results if r.get('dev_f1') is not None] or [None], key=lambda r: r and r['dev_f1'])
+    pool = ThreadPool(args['jobs'])
+    try:
+        for entry in pool.imap_unordered(run_trial, [(name, params, args['threads']) for params in trials]):
+            with open(fname, 'a') as dst:
+                dst.write(json.dumps(entry, sort_keys=True) + '\n')
+            if entry.get('dev_f1') is not None and (best is None or entry['dev_f1'] > best['dev_f1']):
+                best = entry
+            logging.info('trial {} status: {} dev f1: {} time: {:.1f}'.format(entry['id'], entry['status'], entry.get('dev_f1'), entry['time']))
+            if best:
+                logging.info('best so far {} dev f1: {} tst f1: {} epoch: {} nupdate: {} {}'.format(
+                    best['id'], best['dev_f1'], best['tst_f1'], best['epoch'], best.get('nupdate'), ' '.join(trial_argv(best['params']))))
+    except KeyboardInterrupt:
+        logging.info('interrupted, finished trials are kept in {}, rerun to resume'.format(fname))
+        pool.terminate()
+    else:
+        pool.close()
+    pool.join()
+
+if __name__ == '__main__':
+    main()
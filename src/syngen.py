@@ -0,0 +1,88 @@
+""" synthetic bio datasets of a given size, sent length distribution, alphabet size (NF) and tag set size (NC) """
+import os
+import logging
+import argparse
+import numpy as np
+
+from sample import write_to_file
+from utils import DATA_DIR, logger
+
+TYPES = ['PER', 'LOC', 'ORG', 'MISC']
+
+def get_args():
+    parser = argparse.ArgumentParser(prog="syngen")
+
+    parser.add_argument("lang", help="dataset name, the files are written to the data dir as <lang>/train|testa|testb.bio")
+    parser.add_argument("--tokens", default=100000, type=int, help="num of words in train.bio")
+    parser.add_argument("--dev", default=.1, type=float, help="size of testa.bio and testb.bio relative to train.bio")
+    parser.add_argument("--lens", default='poisson', choices=['poisson', 'lognormal', 'uniform', 'fixed'], help="distribution of the num of words of a sent")
+    parser.add_argument("--mean_words", default=12, type=float, help="mean num of words of a sent, the max for uniform")
+    parser.add_argument("--sigma", default=1., type=float, help="sigma of lognormal sent lengths, larger gives a longer tail")
+    parser.add_argument("--word_len", default=5, type=float, help="mean num of chars of a word")
+    parser.add_argument("--nalpha", default=26, type=int, help="num of distinct letters, NF of the basic feat is nalpha+1 with the space")
+    parser.add_argument("--ntype", default=4, type=int, help="num of entity types, NC of char tagging is ntype+1")
+    parser.add_argument("--ent", default=.2, type=float, help="prob of an entity starting at a word")
+    parser.add_argument("--seed", default=7, type=int)
+
+    return vars(parser.parse_args())
+
+def alphabet(nalpha):
+    """ a-z, then letters from the latin extended block on """
+    return [unichr(ord(u'a') + i) if i < 26 else unichr(0x100 + i - 26) for i in range(nalpha)]
+
+def sent_lens(n, rng, lens='poisson', mean_words=12, sigma=1.):
+    if lens == 'poisson':
+        nws = rng.poisson(mean_words, n)
+    elif lens == 'lognormal': # mean_words is the mean of the distribution
+        nws = rng.lognormal(np.log(mean_words) - sigma**2 / 2, sigma, n)
+    elif lens == 'uniform':
+        nws = rng.randint(1, int(mean_words)+1, n)
+    elif lens == 'fixed':
+        nws = np.repeat(mean_words, n)
+    else:
+        raise ValueError('unknown sent length distribution: {}'.format(lens))
+    return np.maximum(np.round(nws).astype(int), 1)
+
+def gen_sents(ntoken, rng, lens='poisson', mean_words=12, sigma=1., word_len=5, nalpha=26, ntype=4, ent=.2):
+    """ sents of random words up to ntoken words, entities of ntype types tagged in bio """
+    letters = np.array(alphabet(nalpha))
+    types = (TYPES + ['T{}'.format(i) for i in range(len(TYPES), ntype)])[:ntype]
+    sents, nword = [], 0
+    while nword < ntoken:
+        for nw in sent_lens(1000, rng, lens, mean_words, sigma):
+            nw = min(nw, ntoken - nword)
+            wlens = 1 + rng.poisson(word_len - 1, nw)
+            chars = letters[rng.randint(nalpha, size=wlens.sum())]
+            ends = np.cumsum(wlens)
+            ws = [u''.join(chars[e-l:e]) for l, e in zip(wlens, ends)]
+            ts = []
+            while len(ts) < nw:
+                if rng.rand() < ent:
+                    typ, n = types[rng.randint(ntype)], min(1+rng.poisson(.5), nw-len(ts))
+                    ts += ['B-'+typ] + ['I-'+typ] * (n-1)
+                else:
+                    ts.append('O')
+            sents.append({'ws': ws, 'ts': ts})
+            nword += nw
+            if nword >= ntoken:
+                break
+    return sents
+
+def gen_dset(lang, tokens, dev=.1, seed=7, **kwargs):
+    """ writes train, testa and testb of a synthetic lang to the data dir, returns their num of sents """
+    rng = np.random.RandomState(seed)
+    dirname = '{}/{}'.format(DATA_DIR, lang)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    nsents = []
+    for fname, ntoken in zip(('train', 'testa', 'testb'), (tokens, int(tokens*dev), int(tokens*dev))):
+        sents = gen_sents(max(ntoken, 1), rng, **kwargs)
+        write_to_file('{}/{}.bio'.format(dirname, fname), sents)
+        nsents.append(len(sents))
+    logging.info('{}: {} words, {} {} {} sents'.format(dirname, tokens, *nsents))
+    return nsents
+
+if __name__ == '__main__':
+    logger()
+    args = get_args()
+    gen_dset(**args)
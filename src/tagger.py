@@ -0,0 +1,344 @@
+import os, sys, re, time
+import logging
+import argparse
+import threading, Queue
+import BaseHTTPServer, SocketServer, urlparse
+import hashlib
+from collections import OrderedDict
+import random, numpy as np
+
+from dataset import Dset, from_words
+import featchar, decoder, rep
+from bundle import load_bundle
+from batching import Batcher, BatchStream, Reporter
+from score import conlleval
+from utils import MODEL_DIR
+
+def get_args():
+    parser = argparse.ArgumentParser(prog="tagger")
+
+    parser.add_argument("model", help="model file saved by exper with --save, absolute or relative to the models dir")
+    parser.add_argument("--input", default='-', help="file to tag, -: stdin")
+    parser.add_argument("--output", default='-', help="file to write the tags to, -: stdout")
+    parser.add_argument("--format", default='text', choices=['text','bio'], help="text: one sentence per line, bio: one word per line with its gold tag last")
+    parser.add_argument("--enc", default='utf-8', help="encoding of the input and output")
+    parser.add_argument("--chunk", default=1000, type=int, help="num of sents to tag at a time when reading a stream")
+    parser.add_argument("--n_batch", default=0, type=int, help="batch size, 0: the one of the model")
+    parser.add_argument("--max_chars", default=0, type=int, help="max padded chars per batch for bucket batching, 0: the one of the model")
+    parser.add_argument("--quant", default='', choices=['','int8','float16'], help="with --rnn numpy, keep the weights quantized, see quantize.py")
+    parser.add_argument("--qclip", default=1., type=float, help="int8 range as a per column abs value quantile, the one quantize.py calibrates")
+    parser.add_argument("--cache", default=1<<22, type=int, help="max chars of the sents whose tags are kept for repeated sents, 0: no cache")
+    parser.add_argument("--score", default=0, type=int, help="run conlleval against the gold tags of bio input")
+    parser.add_argument("--rnn", default='lazrnn', choices=['dummy','lazrnn','numpy'], help="which rnn to use, numpy: predict without importing theano")
+
+    parser.add_argument("--serve", default=0, type=int, help="serve over http on this port instead of tagging the input")
+    parser.add_argument("--max_sents", default=256, type=int, help="max num of sents in a micro batch of requests")
+    parser.add_argument("--max_wait", default=0.01, type=float, help="seconds to wait for more requests before tagging a micro batch")
+
+    return vars(parser.parse_args())
+
+class Tagger(object):
+    """ a saved model with its features and decoder, tags tokenized sents """
+
+    def __init__(self, fname, rnn='lazrnn', n_batch=0, max_chars=0, quant='', qclip=1., cache=None):
+        """ cache is a PredCache, it can be shared by taggers since its keys include the model id """
+        start_time = time.time()
+        bundle = load_bundle(model_file(fname))
+        argsd = bundle['argsd']
+        self.argsd = argsd
+        self.cache = cache
+        self.model_id = model_id(bundle, rnn, quant, qclip)
+        self.level = argsd.get('level', 'char')
+
+        if bundle['feat']:
+            self.feat, self.charrep = bundle['feat'], bundle['charrep']
+            tdecoder = decoder.get_decoder(self.level, self.feat, transition_tensor=bundle['transition_tensor'])
+        else: # a model saved with only its params, the feat and the decoder are fit on its trn data, seeded as in exper
+            random.seed(7)
+            dset = Dset(**argsd)
+            self.charrep = dset.charrep
+            self.feat = featchar.Feat(argsd['feat'])
+            self.feat.fit(dset)
+            tdecoder = decoder.get_decoder(self.level, self.feat, dset.trn)
+        self.reporter = Reporter(self.level, self.feat, tdecoder)
+        self.repobj = getattr(rep, 'Rep'+self.charrep)()
+
+        ids = argsd.get('ids', 0) and self.feat.compiled
+        if rnn == 'numpy': # theano is only imported for the theano rnns
+            from npinfer import RDNN_Numpy as RNN
+            floatX = 'float32'
+        else:
+            import theano
+            from lazrnn import RDNN, RDNN_Dummy
+            RNN = RDNN_Dummy if rnn == 'dummy' else RDNN
+            floatX = theano.config.floatX
+        self.batcher = Batcher(n_batch or argsd['n_batch'], self.feat, ids, argsd.get('batching', 'fixed'),
+                max_chars or argsd.get('max_chars', 4096), argsd.get('bucket_width', 16), floatX)
+        self.rdnn = RNN(self.feat.NC, self.feat.NF, argsd, ftable=self.feat.ftable if ids else None, predict_only=True)
+        self.rdnn.set_param_values(bundle.pop('rnn_param_values')) # not kept by the bundle, quantizing frees the floats
+        if quant:
+            if rnn != 'numpy':
+                raise ValueError('only the numpy rnn runs quantized')
+            from quantize import quantize_net, release_heap
+            self.rdnn = quantize_net(self.rdnn, quant, qclip)
+            release_heap()
+        logging.info('tagger ready in {:.2f} sec'.format(time.time() - start_time))
+
+    def tag(self, wss):
+        """ returns a list of bio tags for each sent in wss, a list of word lists, sents seen before are not predicted again """
+        if self.cache is None:
+            return self.predict(wss)
+        keys = [self.cache_key(ws) for ws in wss]
+        tss = [self.cache.get(key) for key in keys]
+        misses = OrderedDict((key, ws) for key, ws, ts in zip(keys, wss, tss) if ts is None) # repeats within wss are predicted once
+        if len(misses):
+            new = dict(zip(misses, self.predict(misses.values())))
+            for key, ws in misses.iteritems():
+                self.cache.put(key, new[key], sum(len(w) for w in ws) + len(ws))
+            tss = [ts if ts is not None else list(new[key]) for key, ts in zip(keys, tss)]
+        return tss
+
+    def cache_key(self, ws):
+        """ the chars of a sent in the charrep of the model, with the word lengths that map its tags back to the words """
+        return (self.model_id, tuple(self.repobj.get_cseq({'ws': ws})), tuple(len(w) for w in ws))
+
+    def predict(self, wss):
+        """ tags wss with the rnn and the decoder """
+        if not len(wss):
+            return []
+        corpus = from_words(wss, self.level, self.charrep)
+        order = np.argsort(corpus.lens, kind='mergesort') # similar lengths in a batch
+        stream = BatchStream(self.batcher, corpus.take(order), ncache=0)
+        order = order[np.concatenate(stream.plan)]
+
+        mcost, pred = self.rdnn.predict(stream)
+        y_pred = np.concatenate(self.reporter.decode(stream.sents, pred))
+        ts = self.reporter.tfunc(stream.sents, self.feat.yenc.classes_[y_pred]).tolist()
+
+        woffs = stream.sents.woffs
+        tss = [None] * len(wss)
+        for i, si in enumerate(order):
+            tss[si] = ts[woffs[i]:woffs[i+1]]
+        return tss
+
+class PredCache(object):
+    """ LRU of the predicted tags of sents, bounded by the total num of chars of the cached sents """
+
+    def __init__(self, max_chars):
+        self.max_chars = max_chars
+        self.entries = OrderedDict() # key: (ts, nchar)
+        self.nchar = 0
+        self.hits, self.lookups = 0, 0
+
+    def get(self, key):
+        self.lookups += 1
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        self.entries[key] = entry
+        self.hits += 1
+        return list(entry[0])
+
+    def put(self, key, ts, nchar):
+        if key in self.entries:
+            self.nchar -= self.entries.pop(key)[1]
+        if nchar > self.max_chars:
+            return
+        self.entries[key] = (tuple(ts), nchar)
+        self.nchar += nchar
+        while self.nchar > self.max_chars:
+            self.nchar -= self.entries.popitem(last=False)[1][1]
+
+    def stats(self):
+        return 'cache hits: {} / {} ({:.1f}%) sents: {} chars: {}'.format(
+            self.hits, self.lookups, 100. * self.hits / max(self.lookups, 1), len(self.entries), self.nchar)
+
+class MicroBatcher(object):
+    """ tags the sents of concurrent requests together, waits at most max_wait secs for a micro batch to fill up """
+
+    def __init__(self, tagger, max_sents=256, max_wait=0.01):
+        self.tagger = tagger
+        self.max_sents = max_sents
+        self.max_wait = max_wait
+        self.requests = Queue.Queue()
+        self.nreq, self.nbatch = 0, 0
+        worker = threading.Thread(target=self.run)
+        worker.daemon = True
+        worker.start()
+
+    def tag(self, wss):
+        done, result = threading.Event(), {}
+        self.requests.put((wss, done, result))
+        done.wait()
+        if 'error' in result:
+            raise result['error']
+        return result['tss']
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            nsents, deadline = len(batch[0][0]), time.time() + self.max_wait
+            while nsents < self.max_sents and time.time() < deadline:
+                try:
+                    batch.append(self.requests.get(timeout=max(deadline - time.time(), 0)))
+                    nsents += len(batch[-1][0])
+                except Queue.Empty:
+                    break
+
+            try:
+                tss = self.tagger.tag([ws for wss, done, result in batch for ws in wss])
+            except Exception as e:
+                logging.exception('tagging failed')
+                tss, error = None, e
+            start = 0
+            for wss, done, result in batch:
+                if tss is not None:
+                    result['tss'] = tss[start:start+len(wss)]
+                elif len(batch) == 1:
+                    result['error'] = error
+                else: # each request on its own, so only the one with the bad input gets an error
+                    try:
+                        result['tss'] = self.tagger.tag(wss)
+                    except Exception as e:
+                        logging.exception('tagging a request failed')
+                        result['error'] = e
+                start += len(wss)
+                done.set()
+            self.nreq += len(batch); self.nbatch += 1
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def make_handler(mbatcher, enc):
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        """ POST text (one sent per line) or bio (?format=bio) input, responds with the tagged sents in bio format """
+
+        def do_GET(self):
+            self.respond(200, 'ok\n' if self.path == '/health' else 'POST sents to tag\n')
+
+        def do_POST(self):
+            query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+            fmt = query.get('format', ['text'])[0]
+            body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+            try:
+                sents = list(read_input(body.splitlines(), fmt, enc))
+                tss = mbatcher.tag([ws for ws, ts in sents])
+            except Exception as e:
+                self.respond(500, '{}\n'.format(e))
+                return
+            self.respond(200, ''.join(format_sent(ws, ts, tpred, enc) for (ws, ts), tpred in zip(sents, tss)))
+
+        def respond(self, code, text):
+            self.send_response(code)
+            self.send_header('Content-Type', 'text/plain; charset={}'.format(enc))
+            self.send_header('Content-Length', str(len(text)))
+            self.end_headers()
+            self.wfile.write(text)
+
+        def log_message(self, fmt, *args):
+            logging.debug(fmt % args)
+
+    return Handler
+
+def model_id(bundle, rnn, quant, qclip):
+    """ digest of everything the predicted tags depend on """
+    h = hashlib.md5(repr((sorted(bundle['argsd'].items()), rnn, quant, qclip)))
+    for v in bundle['rnn_param_values']:
+        h.update(np.ascontiguousarray(v).tobytes())
+    if bundle['transition_tensor'] is not None:
+        h.update(np.ascontiguousarray(bundle['transition_tensor']).tobytes())
+    return h.hexdigest()
+
+def model_file(fname):
+    for f in (fname, fname+'.npz', '{}/{}'.format(MODEL_DIR, fname), '{}/{}.npz'.format(MODEL_DIR, fname)):
+        if os.path.exists(f):
+            return f
+    raise IOError('model file not found: {}'.format(fname))
+
+def tokenize(line):
+    """ words and punctuation marks, as in the conll data """
+    return re.findall(r'\w+|[^\w\s]', line, re.UNICODE)
+
+def read_input(lines, fmt='text', enc='utf-8'):
+    """ yields (ws, ts) of each sent, ts is None for text input """
+    if fmt == 'text':
+        for l in lines:
+            ws = tokenize(l.decode(enc))
+            if len(ws):
+                yield ws, None
+    else:
+        a = []
+        for l in lines:
+            if len(l.strip()):
+                a.append(l.strip().split('\t'))
+            elif len(a):
+                yield [el[0].decode(enc) for el in a], [el[-1].upper() for el in a]
+                a = []
+        if len(a):
+            yield [el[0].decode(enc) for el in a], [el[-1].upper() for el in a]
+
+def format_sent(ws, ts, tpred, enc='utf-8'):
+    """ bio lines of a sent, the gold tag is kept before the predicted one if there is any """
+    cols = [ws, ts, tpred] if ts is not None else [ws, tpred]
+    return ''.join('\t'.join(cs).encode(enc) + '\n' for cs in zip(*cols)) + '\n'
+
+def chunks(it, n):
+    chunk = []
+    for e in it:
+        chunk.append(e)
+        if len(chunk) == n:
+            yield chunk
+            chunk = []
+    if len(chunk):
+        yield chunk
+
+def tag_stream(tagger, src, dst, fmt='text', enc='utf-8', chunk=1000):
+    """ tags src chunk by chunk, returns the gold and predicted tags of bio input """
+    lts, lts_pred = [], []
+    nsent, nword, start_time = 0, 0, time.time()
+    for sents in chunks(read_input(src, fmt, enc), chunk):
+        tss = tagger.tag([ws for ws, ts in sents])
+        for (ws, ts), tpred in zip(sents, tss):
+            dst.write(format_sent(ws, ts, tpred, enc))
+            if ts is not None:
+                lts.append(ts); lts_pred.append(tpred)
+        dst.flush()
+        nsent += len(sents); nword += sum(len(ws) for ws, ts in sents)
+    mtime = time.time() - start_time
+    logging.info('tagged {} sents {} words in {:.2f} sec, {:.1f} sents/sec'.format(nsent, nword, mtime, nsent / max(mtime, 1e-6)))
+    if tagger.cache is not None:
+        logging.info(tagger.cache.stats())
+    return lts, lts_pred
+
+def main():
+    args = get_args()
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    shandler = logging.StreamHandler(sys.stderr)
+    logger.addHandler(shandler)
+
+    cache = PredCache(args['cache']) if args['cache'] else None
+    tagger = Tagger(args['model'], args['rnn'], args['n_batch'], args['max_chars'], args['quant'], args['qclip'], cache)
+
+    if args['serve']:
+        mbatcher = MicroBatcher(tagger, args['max_sents'], args['max_wait'])
+        server = ThreadedHTTPServer(('', args['serve']), make_handler(mbatcher, args['enc']))
+        logging.info('serving on port {}'.format(args['serve']))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logging.info('{} requests in {} micro batches'.format(mbatcher.nreq, mbatcher.nbatch))
+            if cache is not None:
+                logging.info(cache.stats())
+        return
+
+    src = sys.stdin if args['input'] == '-' else open(args['input'])
+    dst = sys.stdout if args['output'] == '-' else open(args['output'], 'w')
+    lts, lts_pred = tag_stream(tagger, src, dst, args['format'], args['enc'], args['chunk'])
+    if args['score'] and len(lts):
+        (wacc, pre, recall, f1), conll_print = conlleval(lts, lts_pred)
+        logging.info(conll_print)
+
+if __name__ == '__main__':
+    main()
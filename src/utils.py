@@ -11,6 +11,7 @@ LOG_DIR = '{}/logs'.format(ROOT_DIR)
 MODEL_DIR = '{}/models'.format(ROOT_DIR)
 DATA_DIR = '{}/data'.format(ROOT_DIR)
 SRC_DIR = '{}/src'.format(ROOT_DIR)
+CACHE_DIR = '{}/cache'.format(ROOT_DIR)
 
 WSTART = '/w'
 WEND = 'w/'
@@ -94,6 +94,40 @@ def viterbi_log_multi(emission_dist, transition_dist, emissions, wmat):
 
     return state_seq
 
+def viterbi_log_batch(emission_dist, transition_dist, wmat, mask):
+    """
+    emission_dist: nbatch x mlen x num_states log-probs (padded)
+    transition_dist: ntranstypes x num_states x num_states
+    wmat: nbatch x mlen transition type indices
+    mask: nbatch x mlen, each row is a prefix of True values
+    returns nbatch x mlen state indices, entries beyond a sentence's length are meaningless
+    """
+    nbatch, mlen, num_states = emission_dist.shape
+    mask = mask.astype(bool)
+    initial_dist = np.log(np.array([1.0/num_states for i in range(num_states)]))
+    probs = emission_dist[:,0,:] + initial_dist
+    bindx, sindx = np.arange(nbatch), np.arange(num_states)
+    keep_ixs = np.tile(sindx, (nbatch,1)) # padded steps point back to the same state
+    stack = []
+
+    for t in range(1, mlen):
+        trans_probs = transition_dist[wmat[:,t]] + probs[:,:,np.newaxis] # nbatch x num_states x num_states
+        max_col_ixs = np.argmax(trans_probs, axis=1)
+        step_probs = emission_dist[:,t,:] + trans_probs[bindx[:,np.newaxis], max_col_ixs, sindx]
+
+        step_mask = mask[:,t,np.newaxis]
+        probs = np.where(step_mask, step_probs, probs)
+        stack.append(np.where(step_mask, max_col_ixs, keep_ixs))
+
+    state_seqs = np.zeros((nbatch, mlen), dtype=np.int32)
+    state_seqs[:,-1] = np.argmax(probs, axis=1)
+
+    for t in range(mlen-1, 0, -1):
+        max_col_ixs = stack.pop()
+        state_seqs[:,t-1] = max_col_ixs[bindx, state_seqs[:,t]]
+
+    return state_seqs
+
 if __name__ == '__main__':
     transtypes, ntags = 3,3
     transition_probs_tensor = np.zeros((transtypes,ntags,ntags))